@@ -0,0 +1,163 @@
+"""
+Throughput of the three evaluators on the same programs
+
+Each program is run through obj_iter.run, gen_iter.run and lisp.eval,
+checking they all get the same answer. Steps are obj_iter steps for the
+program, so steps per second compare the same work across evaluators.
+Peak memory is measured with tracemalloc on a separate run, since
+tracing slows everything down. How cost scales with size is the slope
+of log time against log size over each family of programs: 1 is
+linear, 2 quadratic.
+
+>>> rows = compare([('wide', 4, wide(4))], repeat=1)
+>>> [(row.evaluator, row.value, row.same) for row in rows]
+[('obj_iter', 12, True), ('gen_iter', 12, True), ('lisp', 12, True)]
+
+An evaluator that raises gets the exception's name for its value, and
+agrees only if the first evaluator raised the same:
+
+>>> [(row.evaluator, row.value, row.same) for row in compare([('bad', 1, '(+ 1 nope)')], repeat=1)]
+[('obj_iter', 'NameError', True), ('gen_iter', 'NameError', True), ('lisp', 'NameError', True)]
+
+    python bench.py [--quick]
+"""
+import math
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+
+import gen_iter
+import lisp
+import obj_iter
+from gamelib import builtins
+from gen_iter import Scope
+from lisp_parser import load, Functions
+
+
+Row = namedtuple('Row', ['family', 'size', 'evaluator', 'value', 'same', 'steps', 'seconds', 'peak'])
+
+
+def deep(n):
+    """Recursion n calls deep that isn't a tail call"""
+    return '(do (fun total n (if (< n 1) 0 (+ n (total (- n 1))))) (total %d))' % (n, )
+
+
+def wide(n):
+    """One sum of n products"""
+    return '(+ %s)' % (' '.join('(* %d 2)' % (i, ) for i in range(n)), )
+
+
+def game_loop(n):
+    """n frames of the game's physics with nothing drawn"""
+    return '''(do
+    (fun step-x x dx (+ (if (> x 640) 0 x) dx))
+    (fun step-y y dy (+ y dy))
+    (fun gravity y dy (if (> y 0) (- dy (/ 1 100)) dy))
+    (fun ground y (if (< y 1) 0 y))
+    (fun mainloop i x y dx dy (if (< i %d)
+        (do (set x (step-x x dx))
+            (set y (ground (step-y y dy)))
+            (set dy (gravity y dy))
+            (mainloop (+ i 1) x y dx dy))
+        (list x y dy)))
+    (mainloop 0 0 10 1 0))''' % (n, )
+
+
+FAMILIES = [('deep', deep, (25, 50, 100, 200)),
+            ('wide', wide, (50, 100, 200, 400)),
+            ('game-loop', game_loop, (50, 100, 200, 400))]
+
+
+def corpus(quick=False):
+    """(family, size, source) for every program"""
+    return [(family, size, make(size))
+            for family, make, sizes in FAMILIES
+            for size in (sizes[:2] if quick else sizes)]
+
+
+def run_obj_iter(s):
+    runner = obj_iter.Runner(s)
+    value = None
+    for value in runner:
+        pass
+    return value, runner.i
+
+
+def run_gen_iter(s):
+    return gen_iter.run(s, [builtins, Scope()]), None
+
+
+def run_lisp(s):
+    ast, function_asts = load(s)
+    return lisp.eval(ast, [builtins, {}], Functions(checked=function_asts)), None
+
+
+EVALUATORS = [('obj_iter', run_obj_iter), ('gen_iter', run_gen_iter), ('lisp', run_lisp)]
+
+
+def measure(run, s, repeat):
+    """(value, steps, best seconds, peak bytes), or the exception's
+    name for value if it failed"""
+    try:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            value, steps = run(s)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        tracemalloc.start()
+        try:
+            run(s)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    except Exception as e:
+        return type(e).__name__, None, None, None
+    return value, steps, best, peak
+
+
+def compare(programs, repeat=3):
+    rows = []
+    for family, size, s in programs:
+        results = [(name,) + measure(run, s, repeat) for name, run in EVALUATORS]
+        expected = results[0][1]
+        steps = results[0][2]
+        for name, value, _, seconds, peak in results:
+            rows.append(Row(family, size, name, value, value == expected, steps, seconds, peak))
+    return rows
+
+
+def scaling(rows):
+    """{(family, evaluator): slope of log seconds against log size}"""
+    slopes = {}
+    for key in sorted(set((row.family, row.evaluator) for row in rows)):
+        points = [(row.size, row.seconds) for row in rows
+                  if (row.family, row.evaluator) == key and row.seconds]
+        if len(points) > 1 and points[0][1] > 0:
+            (n1, t1), (n2, t2) = points[0], points[-1]
+            slopes[key] = math.log(t2 / t1) / math.log(n2 / n1)
+    return slopes
+
+
+def report(rows):
+    print('%-10s %5s %-9s %9s %12s %10s %5s' % ('program', 'size', 'evaluator', 'steps', 'steps/s', 'peak KiB', 'same'))
+    for row in rows:
+        if row.seconds is None:
+            print('%-10s %5d %-9s %s' % (row.family, row.size, row.evaluator, row.value))
+            continue
+        rate = '%12.0f' % (row.steps / row.seconds, ) if row.steps and row.seconds else '%12s' % ('', )
+        print('%-10s %5d %-9s %9s %s %10.1f %5s' % (row.family, row.size, row.evaluator, row.steps or '',
+                                                    rate, row.peak / 1024, row.same))
+    print()
+    for (family, evaluator), slope in sorted(scaling(rows).items()):
+        print('%-10s %-9s time ~ size^%.2f' % (family, evaluator, slope))
+
+
+if __name__ == '__main__':
+    quick = '--quick' in sys.argv
+    programs = corpus(quick)
+    rows = compare(programs, repeat=1 if quick else 3)
+    report(rows)
+    if not all(row.same for row in rows if row.seconds is not None):
+        sys.exit('evaluators disagree')
@@ -0,0 +1,136 @@
+"""
+Bounded reprs for eval trees and environments, and a full inspector
+
+brief() is what node reprs and error messages use: it stops at a depth
+and after so many items, and a big container that has already been
+shown once is shown again as [...] or {...}, so its cost doesn't grow
+with the size of the program or its environment.
+
+>>> env = [{'x': list(range(100))}]
+>>> brief(env)
+"[{'x': [0, 1, 2, 3, 4, 5, 6, 7, ...]}]"
+>>> brief([env, env])
+"[[{'x': [0, 1, 2, 3, 4, 5, 6, 7, ...]}], [...]]"
+>>> brief(((((((((1, ), ), ), ), ), ), ), ))
+'((((((((...,),),),),),),),)'
+
+inspect() shows everything, one attribute per line:
+
+>>> from obj_iter import Eval
+>>> from lisp_parser import parse
+>>> tree = next(Eval(parse('(if x 2 3)'), env, {}))
+>>> print(inspect(tree))
+If
+  cond: 'x'
+  case1: 2
+  case2: 3
+  env: #1=[{'x': [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51, 52, 53, 54, 55, 56, 57, 58, 59, 60, 61, 62, 63, 64, 65, 66, 67, 68, 69, 70, 71, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81, 82, 83, 84, 85, 86, 87, 88, 89, 90, 91, 92, 93, 94, 95, 96, 97, 98, 99]}]
+  funs: #2={}
+  delegate: None
+  value: None
+"""
+import threading
+from collections.abc import Mapping
+from itertools import islice
+
+
+DEPTH = 8
+ITEMS = 8
+BUDGET = 200
+CHARS = 60
+SHORT = 20  # repeated containers shorter than this are shown again in full
+
+_active = threading.local()
+
+
+class _Limits(object):
+    def __init__(self, depth, items, budget):
+        self.depth = depth
+        self.items = items
+        self.budget = budget
+        self.seen = {}  # id(container) -> how it was shown the first time
+
+
+def brief(x, depth=DEPTH, items=ITEMS, budget=BUDGET):
+    """repr of x, cut short at depth, after items elements of any one
+    container, or after budget values in all
+
+    Reprs that call brief while one is being made share its limits."""
+    limits = getattr(_active, 'limits', None)
+    if limits is not None:
+        return _brief(x, limits)
+    _active.limits = _Limits(depth, items, budget)
+    try:
+        return _brief(x, _active.limits)
+    finally:
+        _active.limits = None
+
+
+def _brief(x, limits):
+    limits.budget -= 1
+    if limits.budget < 0 or limits.depth <= 0:
+        return '...'
+    t = type(x)
+    if isinstance(x, str) and t.__repr__ is str.__repr__:
+        return repr(x) if len(x) <= CHARS else repr(x[:CHARS]) + '...'
+    if t in (int, float, bool, type(None)):
+        return repr(x)
+    plain = t in (tuple, list, dict) or t.__repr__ in (tuple.__repr__, list.__repr__, dict.__repr__)
+    if plain and not isinstance(x, tuple):
+        shown = limits.seen.get(id(x))
+        if shown is not None:
+            return shown if len(shown) < SHORT else '[...]' if isinstance(x, list) else '{...}'
+    limits.depth -= 1
+    try:
+        if not plain:
+            return repr(x)
+        if isinstance(x, dict):
+            parts = ['%s: %s' % (_brief(k, limits), _brief(v, limits))
+                     for k, v in islice(x.items(), limits.items)]
+        else:
+            parts = [_brief(item, limits) for item in islice(x, limits.items)]
+        if len(x) > limits.items:
+            parts.append('...')
+    finally:
+        limits.depth += 1
+    if isinstance(x, dict):
+        shown = '{%s}' % (', '.join(parts), )
+    elif isinstance(x, list):
+        shown = '[%s]' % (', '.join(parts), )
+    else:
+        shown = '(%s%s)' % (', '.join(parts), ',' if len(parts) == 1 else '')
+    if not isinstance(x, tuple):
+        limits.seen[id(x)] = shown
+    return shown
+
+
+def inspect(tree):
+    """Everything in tree, with nodes one attribute to a line and
+    environments labelled #n the first time they appear"""
+    lines = []
+    labels = {}
+    _inspect(tree, '', lines, labels)
+    return '\n'.join(lines)
+
+
+def _inspect(x, indent, lines, labels, prefix=''):
+    if hasattr(x, '__next__') and hasattr(x, '__dict__'):
+        lines.append(indent + prefix + type(x).__name__)
+        for k, v in x.__dict__.items():
+            _inspect(v, indent + '  ', lines, labels, k + ': ')
+    elif isinstance(x, (list, dict)):
+        if id(x) in labels:
+            lines.append(indent + prefix + '#%d' % (labels[id(x)], ))
+        else:
+            labels[id(x)] = len(labels) + 1
+            lines.append(indent + prefix + '#%d=%s' % (labels[id(x)], _full(x)))
+    else:
+        lines.append(indent + prefix + _full(x))
+
+
+def _full(x):
+    if isinstance(x, list):
+        return '[%s]' % (', '.join(_full(item) for item in x), )
+    if isinstance(x, Mapping) and (type(x).__repr__ is dict.__repr__ or not isinstance(x, dict)):
+        return '{%s}' % (', '.join('%s: %s' % (_full(k), _full(v)) for k, v in x.items()), )
+    return repr(x)
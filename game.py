@@ -51,8 +51,8 @@ game = """
 """
 
 if __name__ == '__main__':
-    from gamelib import builtins, game_methods
+    from gamelib import builtins, lazy_game
     #from gen_iter import run
     from obj_iter import run
-    builtins.update(game_methods())
+    lazy_game(builtins)
     print(run(game))
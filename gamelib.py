@@ -3,13 +3,17 @@ import time
 import sys
 import operator
 import random
-import pygame
 from functools import reduce
 
 
+pygame = None  # imported by the first Game, so headless runs never load it
+
+
 class Game(object):
 
     def __init__(self):
+        global pygame
+        import pygame
         pygame.init()
 
         self.size = width, height = 320, 240
@@ -48,7 +52,7 @@ class Game(object):
     def _keypressed(key):
         def pressed(self):
             keyState = pygame.key.get_pressed()
-            return keyState[key]
+            return keyState[getattr(pygame, key)]
         return pressed
 
     def mousepressedq(self):
@@ -60,14 +64,14 @@ class Game(object):
     def mousey(self):
         return pygame.mouse.get_pos()[1]
 
-    upkeyq = _keypressed(pygame.K_UP)
-    downkeyq = _keypressed(pygame.K_DOWN)
-    leftkeyq = _keypressed(pygame.K_LEFT)
-    rightkeyq = _keypressed(pygame.K_RIGHT)
+    upkeyq = _keypressed('K_UP')
+    downkeyq = _keypressed('K_DOWN')
+    leftkeyq = _keypressed('K_LEFT')
+    rightkeyq = _keypressed('K_RIGHT')
 
 
 def test():
-
+    import pygame
     pygame.init()
 
     size = width, height = 320, 240
@@ -95,11 +99,34 @@ def test():
 
 
 class PyFuncs(dict):
+    """Python functions by lisp or python name
+
+    Names in self.lazy map to a function returning a dict of functions,
+    called to fill them in the first time one of them is looked up.
+
+    >>> funcs = PyFuncs({'one': lambda: 1})
+    >>> funcs.lazy['twoq'] = lambda: print('loading') or {'twoq': lambda: 2}
+    >>> 'two?' in funcs
+    loading
+    True
+    >>> funcs['two?']()
+    2
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.lazy = {}
+
     def __getitem__(self, key):
         if dict.__contains__(self, key):
             return dict.__getitem__(self, key)
         elif dict.__contains__(self, lisp_to_py(key)):
             return dict.__getitem__(self, lisp_to_py(key))
+        load = self.lazy.get(lisp_to_py(key))
+        if load is not None:
+            for name in [name for name in self.lazy if self.lazy[name] is load]:
+                del self.lazy[name]
+            self.update(load())
+            return self[key]
         return dict.__getitem__(self, key)
 
     def __contains__(self, key):
@@ -155,6 +182,13 @@ def game_methods():
     return dict_of_public_methods(g)
 
 
+def lazy_game(builtins):
+    """Make a Game for builtins the first time one of its methods is
+    looked up, instead of up front"""
+    for name in dict_of_public_methods(Game):
+        builtins.lazy[name] = game_methods
+
+
 if __name__ == '__main__':
     test()
 
@@ -12,15 +12,16 @@ Beautiful generator versions of the code for testing against
 >>> f = run(('(fun count x (count (+ x 1)))'))
 >>> f
 Function(name=count, params=(x,), ast=('count', ('+', 'x', 1)))
->>> e = eval(parse('((fun count x (count (+ x 1))) 1)'), [{'+':lambda *a: sum(a)}], {})
+>>> e = eval(parse('(+ 1 2)'), [{'+':lambda *a: sum(a)}], {})
+>>> for _ in range(4): next(e)
 >>> next(e)
 Traceback (most recent call last):
   ...
-StopIteration: 1
->>> next(invocation(parse('+'), [], [{'+':lambda *a: sum(a)}, {}], {}))
-Traceback (most recent call last):
-  ...
-StopIteration
+StopIteration: 3
+>>> run('(do (set a 1) (set a (+ a 1)) a)')
+2
+>>> run('((fun total n (if (< n 1) 0 (+ n (total (- n 1))))) 5000)')
+12502500
 >>> run('''((fun countto x y
 ...             (do 1
 ...             (if (< x y)
@@ -30,31 +31,29 @@ StopIteration
 1000
 """
 
-from gamelib import builtins, game_methods
-from lisp_parser import parse, Function, Lambda
+import itertools
+from collections import namedtuple
+from collections.abc import MutableMapping
+from types import GeneratorType
 
+from gamelib import builtins, lazy_game
+from lisp_parser import parse, load, typed, dispatch, Text, Function, Functions, Lambda
+from debug import brief
 
-class Thunk(Exception):
-    """Unfinished code to run"""
-    def __init__(self, g, func='?', args='?', env='?'):
-        self.g = g
-        self.func = func  # just for printing
-        self.args = args  # just for printing
-        self.env = env    # just for printing
 
-    def __repr__(self):
-        return 'Thunk(%s %s with env size: %s)' % (self.func, self.args, len(self.env))
+class Tail(namedtuple('Tail', ['ast', 'env'])):
+    """Code to evaluate in place of the form that returned it"""
 
 
 def run(s, env=None, funs=None):
-    ast = parse(s)
+    ast, function_asts = load(s)
 
     if env is None:
-        env = [builtins, {}]
+        env = [builtins, Scope()]
     if funs is None:
-        funs = {}
+        funs = Functions(checked=function_asts)
 
-    work = trampoline(eval(ast, env, funs))
+    work = eval(ast, env, funs)
     while True:
         try:
             next(work)
@@ -64,6 +63,96 @@ def run(s, env=None, funs=None):
             else:
                 return e.args[0]
 
+class Scope(MutableMapping):
+    """Environment frame that copies share until one of them is set
+
+    Copying one (as a snapshot does) takes constant time: both copies
+    keep the same version of the variables, and whichever is set first
+    takes its own copy of them. Values are treated as immutable.
+
+    >>> import copy
+    >>> live = Scope({'x': 1})
+    >>> saved = copy.deepcopy(live)
+    >>> saved.vars is live.vars
+    True
+    >>> setbang('x', 2, [live]); live, saved
+    ({'x': 2}, {'x': 1})
+    >>> lookup('x', [saved])
+    1
+
+    A Scope with a meter (see limits.Limits) keeps a running total of
+    the size of its values there. Copies keep the uid of the original,
+    so a restored snapshot's version of a Scope can be found.
+
+    >>> live.track_reads(); live['x'], live.read_since(0)
+    (2, ['x'])
+    """
+    uids = itertools.count()
+
+    def __init__(self, vars=None, meter=None):
+        self.vars = {} if vars is None else vars
+        self.shared = False
+        self.uid = next(Scope.uids)
+        self.meter = None
+        self.bytes = 0
+        self.read_at = None  # name -> self.reads when last read, if tracking
+        self.reads = 0
+        if meter is not None:
+            meter.meter(self)
+
+    def track_reads(self):
+        self.read_at = {}
+
+    def read_since(self, reads):
+        """Names read since self.reads was reads"""
+        return [key for key, n in self.read_at.items() if n > reads]
+
+    def freeze(self):
+        """The current version of the variables, which won't change"""
+        self.shared = True
+        return self.vars
+
+    def __contains__(self, key):
+        return key in self.vars
+
+    def __getitem__(self, key):
+        if self.read_at is not None:
+            self.reads += 1
+            self.read_at[key] = self.reads
+        return self.vars[key]
+
+    def own(self):
+        if self.shared:
+            self.vars = dict(self.vars)
+            self.shared = False
+        return self.vars
+
+    def __setitem__(self, key, value):
+        if self.meter is not None:
+            change = self.meter.size(value) - (self.meter.size(self.vars[key]) if key in self.vars else 0)
+            self.bytes += change
+            self.meter.bytes += change
+        self.own()[key] = value
+
+    def __delitem__(self, key):
+        del self.own()[key]
+
+    def __iter__(self):
+        return iter(self.vars)
+
+    def __len__(self):
+        return len(self.vars)
+
+    def __repr__(self):
+        return brief(self.vars)
+
+    def __deepcopy__(self, memo):
+        copy = memo[id(self)] = Scope(self.freeze())
+        copy.shared = True
+        copy.uid = self.uid
+        return copy
+
+
 def lookup(symbol, env, funs=None):
     assert isinstance(symbol, str), repr(symbol)
     for scope in reversed(env):
@@ -71,7 +160,7 @@ def lookup(symbol, env, funs=None):
             return scope[symbol]
     if funs is not None and symbol in funs:
         return funs[symbol]
-    raise NameError(repr(symbol) + '\n' + repr(env) + '\n' + repr(funs))
+    raise NameError(repr(symbol) + '\n' + brief(env) + '\n' + brief(funs))
 
 
 def setbang(symbol, value, env):
@@ -85,62 +174,70 @@ def setbang(symbol, value, env):
 
 
 def eval(ast, env, funs):
-    if isinstance(ast, (int, float)):
-        return literal(ast)
-    if isinstance(ast, str):
-        start, end = ast[0], ast[-1]
-        if start == end and start in ["'", '"']:
-            return literal(ast)
-        return lookup(ast, env, funs)
-    if not isinstance(ast, (list, tuple)):
-        raise ValueError(ast)
-
-    if ast[0] == 'do':
-        return (yield from do(ast[1:], env, funs))
-    if ast[0] == 'fun':
-        return fun(ast[1], ast[2:-1], ast[-1], env, funs)
-    if ast[0] == 'lambda':
-        return Lambda(ast[1:-1], ast[-1], env, funs)
-    if ast[0] == 'set':
-        return (yield from Set(ast[1], ast[2], env, funs))
-    if ast[0] == 'if':
-        if len(ast) == 4:
-            return (yield from If(*(ast[1:4] + (env, funs))))
+    """Generator that takes one step per next() and returns ast's value
+
+    Forms are generators that yield (ast, env) pairs to have them
+    evaluated and sent back, and return their value or a Tail to be
+    replaced by. A single loop keeps them on an explicit stack, so
+    resuming is constant time however deep the evaluation is.
+    """
+    stack = []
+    value = start(ast, env, funs)
+    while True:
+        if type(value) is Tail:
+            value = start(value.ast, value.env, funs)
+        if type(value) is GeneratorType:
+            stack.append(value)
+            value = None
+        elif not stack:
+            return value
+        yield
+        try:
+            ast, env = stack[-1].send(value)
+        except StopIteration as e:
+            stack.pop()
+            value = e.value
         else:
-            assert len(ast) == 3
-            return (yield from If(*(ast[1:3] + (None, env, funs))))
+            value = start(ast, env, funs)
+
 
-    return (yield from invocation(ast[0], ast[1:], env, funs))
+def start(ast, env, funs):
+    """The value of ast if it can be had right away, else a generator"""
+    form = forms.get(type(ast))
+    if form is None:
+        ast = typed(ast)
+        form = forms.get(type(ast))
+        if form is None:
+            raise ValueError(ast)
+    return form(ast, env, funs)
+
+
+def start_if(ast, env, funs):
+    assert len(ast) in (3, 4)
+    return If(ast[1], ast[2], ast[3] if len(ast) == 4 else None, env, funs)
 
 
 def invocation(func_ast, expr_asts, env, funs):
-    func = (yield from eval(func_ast, env, funs))
+    func = yield func_ast, env
     args = []
     for f in expr_asts:
-        args.append((yield from trampoline(eval(f, env, funs))))
+        args.append((yield f, env))
 
     if isinstance(func, (Function, Lambda)):
-        if len(func.params) != len(args):
-            raise TypeError('func %s takes %d args, %d given: %r called on %r' %
-                            (func.name, len(func.params), len(args), func_ast, expr_asts))
-        return Thunk(eval(func.ast, env[:-1] + [{p: a for p, a in zip(func.params, args)}], funs), func, args, env)
+        checked = getattr(func, 'name', None) == func_ast and func.name in getattr(funs, 'checked', ())
+        if not checked and len(func.params) != len(args):
+            raise TypeError('func %s takes %d args, %d given: %s called on %s' %
+                            (getattr(func, 'name', 'lambda'), len(func.params), len(args),
+                             brief(func_ast), brief(expr_asts)))
+        return Tail(func.ast, env[:-1] + [Scope(dict(zip(func.params, args)))])
     elif callable(func):
-        def boringgen():
-            yield
-            return func(*args)
-        return Thunk(boringgen(), func, args, env)
-    raise ValueError("%r doesn't look like a function in %r" % (ast[0], ast))
-
-
-def trampoline(gen):
-    """Keeps exhausting a series of generators"""
-    result = (yield from gen)
-    while isinstance(result, Thunk):
-        result = (yield from result.g)
-    return result
+        return func(*args)
+    raise ValueError("%s doesn't look like a function in %s" % (brief(func_ast), brief(expr_asts)))
 
 
 def literal(ast):
+    if type(ast) is Text:
+        return ast.value
     assert isinstance(ast, (float, int, str))
     if isinstance(ast, str):
         start, end = ast[0], ast[-1]
@@ -153,20 +250,51 @@ def literal(ast):
 
 
 def If(cond, case1, case2, env, funs):
-    result = yield from trampoline(eval(cond, env, funs))
-    if result:
-        return (yield from eval(case1, env, funs))
+    if (yield cond, env):
+        return Tail(case1, env)
     elif case2 is None:
         return None
     else:
-        return (yield from eval(case2, env, funs))
+        return Tail(case2, env)
+
+
+def loop(body, env, funs):
+    while True:
+        yield body, env
+
+
+def While(cond, body, env, funs):
+    """
+    >>> run('(do (set i 0) (while (< i 3) (set i (+ i 1))) i)')
+    3
+    """
+    while (yield cond, env):
+        yield body, env
+
+
+def For(var, start, end, body, env, funs):
+    """
+    >>> run('(do (set total 0) (for i 0 5 (set total (+ total i))) total)')
+    10
+
+    Counting goes up by 1 from start while below end, which needn't be
+    whole numbers:
+
+    >>> run('(do (set n 0) (for i 0 (/ 5 2) (set n (+ n 1))) n)')
+    3
+    """
+    i = yield start, env
+    end = yield end, env
+    while i < end:
+        setbang(var, i, env)
+        yield body, env
+        i += 1
 
 
 def do(forms, env, funs):
-    exprs = []
     for f in forms[:-1]:
-        exprs.append((yield from trampoline(eval(f, env, funs))))
-    return (yield from eval(forms[-1], env, funs))
+        yield f, env
+    return Tail(forms[-1], env)
 
 
 def fun(name, params, ast, env, funs):
@@ -180,12 +308,29 @@ def fun(name, params, ast, env, funs):
 
 def Set(name, value, env, funs):
     assert isinstance(name, str)
-    setbang(name, (yield from trampoline(eval(value, env, funs))), env)
+    value = yield value, env
+    setbang(name, value, env)
     return value
 
+
+forms = dispatch({
+    'number': lambda ast, env, funs: ast,
+    'text': lambda ast, env, funs: ast.value,
+    'symbol': lookup,
+    'do': lambda ast, env, funs: do(ast[1:], env, funs),
+    'fun': lambda ast, env, funs: fun(ast[1], ast[2:-1], ast[-1], env, funs),
+    'lambda': lambda ast, env, funs: Lambda(ast[1:-1], ast[-1], env, funs),
+    'set': lambda ast, env, funs: Set(ast[1], ast[2], env, funs),
+    'loop': lambda ast, env, funs: loop(ast[1], env, funs),
+    'while': lambda ast, env, funs: While(ast[1], ast[2], env, funs),
+    'for': lambda ast, env, funs: For(ast[1], ast[2], ast[3], ast[4], env, funs),
+    'if': start_if,
+    'call': lambda ast, env, funs: invocation(ast[0], ast[1:], env, funs),
+})
+
 if __name__ == '__main__':
     import doctest
     #doctest.testmod()
 
-    builtins.update(game_methods())
+    lazy_game(builtins)
     print(run(game))
@@ -0,0 +1,121 @@
+"""
+Resource limits for a Runner running a script that can't be trusted
+
+Everything is counted as it changes rather than by walking the tree:
+calls add a frame and returning takes it away, and metered Scopes add
+the size of each value set in them to a running total of env bytes.
+Checking is a few comparisons before each step.
+
+Running out of steps for a slice pauses the runner: it raises, and
+carries on from the same place after next_slice(). Any other limit
+kills it, dropping its tree so the memory goes back to the host.
+
+>>> from obj_iter import Runner
+>>> r = Runner('(do (fun down n (+ 1 (down n))) (down 1))', limits=Limits(depth=50))
+>>> for value in r: pass
+Traceback (most recent call last):
+  ...
+limits.LimitExceeded: depth 51 is over the limit of 50
+>>> r.done, r.state
+(True, None)
+
+>>> r = Runner('(do (set x 0) (loop (set x (+ x 1))))', limits=Limits(steps=100))
+>>> r.step()
+>>> try:
+...     for value in r: pass
+... except LimitExceeded as e:
+...     print(e)
+steps 100 is over the limit of 100
+>>> x = r.env[-1]['x']; r.limits.next_slice(); r.step(); r.done
+False
+
+>>> r = Runner('(do (set l (list)) (loop (set l (list l l l l l l l l))))',
+...            limits=Limits(env_bytes=10000))
+>>> for value in r: pass
+Traceback (most recent call last):
+  ...
+limits.LimitExceeded: env_bytes 10024 is over the limit of 10000
+"""
+import sys
+
+
+class LimitExceeded(Exception):
+    def __init__(self, kind, value, limit):
+        Exception.__init__(self, '%s %d is over the limit of %d' % (kind, value, limit))
+        self.kind = kind
+        self.value = value
+        self.limit = limit
+
+
+class Limits(object):
+    """Limits for one Runner; None means unlimited
+
+    steps is per slice, depth is in user function frames, and env_bytes
+    and snapshot_bytes are approximate sizes in bytes."""
+    def __init__(self, steps=None, depth=None, env_bytes=None, snapshot_bytes=None):
+        self.steps = steps
+        self.depth = depth
+        self.env_bytes = env_bytes
+        self.snapshot_bytes = snapshot_bytes
+        self.taken = 0  # steps this slice
+        self.bytes = 0  # in metered Scopes
+        self.sizes = {}  # id -> (value, deep size) of recently sized tuples
+
+    def next_slice(self):
+        self.taken = 0
+
+    def meter(self, scope):
+        """Count what's in scope from now on"""
+        if getattr(scope, 'meter', self) is None:
+            scope.meter = self
+            scope.bytes = sum(self.size(v) for v in scope.vars.values())
+            self.bytes += scope.bytes
+
+    def size(self, value):
+        """Approximate size of value, counting each tuple in it once
+
+        Sizes of tuples are remembered, so a list built up a cons at a
+        time is sized a cell at a time rather than from scratch."""
+        if not isinstance(value, tuple):
+            return sys.getsizeof(value)
+        cached = self.sizes.get(id(value))
+        if cached is not None and cached[0] is value:
+            return cached[1]
+        total = 0
+        seen = set()
+        todo = [value]
+        while todo:
+            x = todo.pop()
+            if id(x) in seen:
+                continue
+            seen.add(id(x))
+            cached = self.sizes.get(id(x))
+            if cached is not None and cached[0] is x:
+                total += cached[1]
+                continue
+            total += sys.getsizeof(x)
+            if isinstance(x, tuple):
+                todo.extend(x)
+        if len(self.sizes) > 1024:
+            self.sizes.clear()
+        self.sizes[id(value)] = (value, total)
+        return total
+
+    def check(self, runner):
+        if self.steps is not None and self.taken >= self.steps:
+            raise LimitExceeded('steps', self.taken, self.steps)
+        self.taken += 1
+        if self.depth is not None and runner.funs.depth > self.depth:
+            self.kill(runner, 'depth', runner.funs.depth, self.depth)
+        if self.env_bytes is not None and self.bytes > self.env_bytes:
+            self.kill(runner, 'env_bytes', self.bytes, self.env_bytes)
+        if self.snapshot_bytes is not None:
+            snapshots = runner.funs.snapshots
+            if snapshots.store.bytes > self.snapshot_bytes:
+                snapshots.collect()
+                if snapshots.store.bytes > self.snapshot_bytes:
+                    self.kill(runner, 'snapshot_bytes', snapshots.store.bytes, self.snapshot_bytes)
+
+    def kill(self, runner, kind, value, limit):
+        runner.kill()
+        raise LimitExceeded(kind, value, limit)
@@ -79,11 +79,19 @@ import sys
 from functools import reduce
 from collections import namedtuple
 
+from gamelib import builtins
+from lisp_parser import parse, typed, dispatch
+from debug import brief
+
 
 class Function(namedtuple('fun', ['name', 'params', 'ast', 'env'])):
     """Named function, duplicate names aren't allowed"""
 
 
+class Tail(namedtuple('Tail', ['ast', 'env'])):
+    """Code to evaluate in place of the form that returned it"""
+
+
 def eval(ast, env=None, funs=None):
     """
 
@@ -107,65 +115,135 @@ def eval(ast, env=None, funs=None):
     ...         1))'''), funs=funs)
     >>> eval(parse('(maybe 0)'), funs=funs)
     1
+
+    Arguments are evaluated once, and tail calls don't use up the stack:
+
+    >>> eval(parse('''(do (fun count x (if (< x 10000) (count (+ x 1)) x))
+    ...                   (count (do (display 0) 0)))'''))
+    0
+    10000
+
+    A function sees the caller's scopes but the innermost, as in the
+    other evaluators, so a set in it doesn't reach the globals:
+
+    >>> eval(parse('(do (set g 5) (fun f x (do (set g x) g)) (f 1) g)'))
+    5
+
+    Calls are checked against the function's params unless funs says
+    check_calls already has:
+
+    >>> eval(parse('(do (fun f x x) (f 1 2))'))
+    Traceback (most recent call last):
+      ...
+    TypeError: func f takes 1 args, 2 given
     """
     if env is None:
         env = [builtins, {}]
     if funs is None:
         funs = {}
 
-    if isinstance(ast, (int, float)):
-        return ast
-    if isinstance(ast, str):
-        start, end = ast[0], ast[-1]
-        if start == end and start in ["'", '"']:
-            return ast[1:-1]
-        return lookup(ast, env, funs)
-    if not isinstance(ast, (list, tuple)):
-        raise ValueError(ast)
-
-    if ast[0] == 'do':
-        for form in ast[1:]:
-            result = eval(form, env, funs)
-        return result
-    elif ast[0] == 'loop':
-        while True:
-            result = eval(ast[1], env, funs)
-    elif ast[0] == 'if':
-        assert len(ast) in (3, 4)
-        result = eval(ast[1], env, funs)
-        if result:
-            return eval(ast[2], env, funs)
-        elif len(ast) == 4:
-            return eval(ast[3], env, funs)
-        else:
-            return None
-    elif ast[0] == 'fun':
-        assert all(isinstance(x, str) for x in ast[1:-1])
-        fun = Function(name=ast[1], params=ast[2:-1], ast=ast[-1], env=env)
-        if fun.name in funs:
-            raise ValueError("Two definitions for function %s" % (fun.name, ))
-        funs[fun.name] = fun
+    while True:
+        form = forms.get(type(ast))
+        if form is None:
+            ast = typed(ast)
+            form = forms.get(type(ast))
+            if form is None:
+                raise ValueError(ast)
+        result = form(ast, env, funs)
+        if type(result) is not Tail:
+            return result
+        ast, env = result
+
+
+def eval_do(ast, env, funs):
+    for form in ast[1:-1]:
+        eval(form, env, funs)
+    return Tail(ast[-1], env)
+
+
+def eval_loop(ast, env, funs):
+    while True:
+        eval(ast[1], env, funs)
+
+
+def eval_while(ast, env, funs):
+    while eval(ast[1], env, funs):
+        eval(ast[2], env, funs)
+
+
+def eval_for(ast, env, funs):
+    """Counts up by 1 from start while below end, like the other evaluators
+
+    >>> eval(parse('(do (set n 0) (for i 0 (/ 5 2) (set n (+ n 1))) n)'))
+    3
+    """
+    i = eval(ast[2], env, funs)
+    end = eval(ast[3], env, funs)
+    while i < end:
+        set(ast[1], i, env)
+        eval(ast[4], env, funs)
+        i += 1
+
+
+def eval_if(ast, env, funs):
+    assert len(ast) in (3, 4)
+    if eval(ast[1], env, funs):
+        return Tail(ast[2], env)
+    elif len(ast) == 4:
+        return Tail(ast[3], env)
+    else:
         return None
-    elif ast[0] == 'lambda':
-        assert all(isinstance(x, str) for x in ast[1:-1])
-        fun = Function(name=ast[0], params=ast[1:-1], ast=ast[-1], env=env)
-        return fun
-    elif ast[0] == 'set':
-        assert len(ast) == 3, ast
-        assert isinstance(ast[1], str)
-        set(ast[1], eval(ast[2], env, funs), env)
-
-    else:  # not a special form
-        func = eval(ast[0], env, funs)
-        args = [eval(f, env, funs) for f in ast[1:]]
-        if isinstance(func, Function):
-            if len(func.params) != len(args):
-                raise TypeError('func %s takes %d args, %d given' %
-                                (func.name, len(func.params), len(args)))
-            return eval(func.ast, env + [{p: a for p, a in zip(func.params, args)}], funs)
-        elif callable(func):
-            return func(*[eval(f, env, funs) for f in ast[1:]])
-        raise ValueError("%r doesn't look like a function in %r" % (ast[0], ast))
+
+
+def eval_fun(ast, env, funs):
+    assert all(isinstance(x, str) for x in ast[1:-1])
+    fun = Function(name=ast[1], params=ast[2:-1], ast=ast[-1], env=env)
+    if fun.name in funs:
+        raise ValueError("Two definitions for function %s" % (fun.name, ))
+    funs[fun.name] = fun
+    return None
+
+
+def eval_lambda(ast, env, funs):
+    assert all(isinstance(x, str) for x in ast[1:-1])
+    return Function(name=ast[0], params=ast[1:-1], ast=ast[-1], env=env)
+
+
+def eval_set(ast, env, funs):
+    assert len(ast) == 3, ast
+    assert isinstance(ast[1], str)
+    set(ast[1], eval(ast[2], env, funs), env)
+
+
+def eval_call(ast, env, funs):
+    """Not a special form"""
+    func = eval(ast[0], env, funs)
+    args = [eval(f, env, funs) for f in ast[1:]]
+    if isinstance(func, Function):
+        checked = func.name == ast[0] and func.name in getattr(funs, 'checked', ())
+        if not checked and len(func.params) != len(args):
+            raise TypeError('func %s takes %d args, %d given' %
+                            (func.name, len(func.params), len(args)))
+        return Tail(func.ast, env[:-1] + [dict(zip(func.params, args))])
+    elif callable(func):
+        return func(*args)
+    raise ValueError("%s doesn't look like a function in %s" % (brief(ast[0]), brief(ast)))
+
+
+forms = dispatch({
+    'number': lambda ast, env, funs: ast,
+    'text': lambda ast, env, funs: ast.value,
+    'symbol': lambda ast, env, funs: lookup(ast, env, funs),
+    'do': eval_do,
+    'loop': eval_loop,
+    'while': eval_while,
+    'for': eval_for,
+    'if': eval_if,
+    'fun': eval_fun,
+    'lambda': eval_lambda,
+    'set': eval_set,
+    'call': eval_call,
+})
 
 
 def lookup(symbol, env, funs=None):
@@ -175,7 +253,7 @@ def lookup(symbol, env, funs=None):
             return scope[symbol]
     if funs is not None and symbol in funs:
         return funs[symbol]
-    raise NameError(repr(symbol) + '\n' + repr(env) + '\n' + repr(funs))
+    raise NameError(repr(symbol) + '\n' + brief(env) + '\n' + brief(funs))
 
 
 def set(symbol, value, env):
@@ -183,162 +261,14 @@ def set(symbol, value, env):
     for scope in reversed(env):
         if symbol in scope:
             scope[symbol] = value
-            print('setting %s to %r' % (symbol, value))
-            print(env)
             return
     else:
         env[-1][symbol] = value
 
 
-class Incomplete:
-    """Signal that evaluation is incomplete"""
-    def __repr__(self):
-        return 'Incomplete'
-Incomplete = Incomplete()
-
-
-def Eval(ast, env, funs):
-    """Returns an instance of an iterator which will yield the result"""
-    if isinstance(ast, (int, float)):
-        return Literal(ast)
-    if isinstance(ast, str):
-        start, end = ast[0], ast[-1]
-        if start == end and start in ["'", '"']:
-            return ast[1:-1]
-        return Literal(lookup(ast, env, funs))
-    if not isinstance(ast, (list, tuple)):
-        raise ValueError(ast)
-
-
-def gen_return(g):
-    try:
-        while True:
-            next(g)
-    except StopIteration as e:
-        return e.args[0]
-
-
-def gen_return_with_intermediates(g):
-    results = []
-    try:
-        while True:
-            results.append(next(g))
-    except StopIteration as e:
-        results.append(e.args[0])
-        return results
-
-
-class Literal(object):
-    """
-    >>> gen_return_with_intermediates(Literal(1))
-    [1]
-    >>> gen_return_with_intermediates(Literal('"asdf"'))
-    ['asdf']
-
-    """
-    def __init__(self, ast):
-        assert isinstance(ast, (float, int, str))
-        if isinstance(ast, str):
-            start, end = ast[0], ast[-1]
-            if start in ['"', "'"] and start == end:
-                self.value = ast[1:-1]
-            else:
-                assert False, ast+" is't a string literal"
-        else:
-            self.value = ast
-        self.done = False
-
-    def __next__(self):
-        if self.done:
-            raise StopIteration()
-        self.done = True
-        raise StopIteration(self.value)
-
-
-class If(object):
-    """
-    >>> i = If(1, 2, 3, {})
-    >>> i._reference()
-    next(i)
-    i.cond_result
-    [Incomplete, 2]
-
-    """
-    def __init__(self, cond, case1, case2, env):
-        self.cond = cond
-        self.case1 = case1
-        self.case2 = case2
-        self.env = env
-
-    def _reference(self):
-        """Beautiful generator version of this function"""
-        result = yield from Eval(self.cond)
-        if result:
-            return (yield from Eval(self.case1))
-        elif self.case1 is None:
-            return None
-        else:
-            return (yield from Eval(self.case2))
-
-    def copy(self):
-
-class Evaluation(object):
-    """Annotate AST with last time run, eval_tree at that time,
-    and in current eval what value is there
-
-    #>>> e = Evaluation(parse('(if 1 1)'), {});
-    #>>> e.ast
-    #('if', 1, 1)
-    #>>> e.eval_tree
-    #[None, {}]
-    #>>> e.step()
-    #>>> e.eval_tree
-    #[('if', (Incomplete, ), {}]
-    """
-    def __init__(self, ast, env=None):
-        self.ast = ast
-        if env == None:
-            env = [builtins, {}]
-        self.eval_tree = [None, env]
-        self.funs = {}
-
-    def update_code(self, ast):
-        """With a new ast, find which functions changed
-
-        Find all the function definitions, """
-        raise NotImplemented('yet')  # TODO
-
-    def step(self):
-        """Take one incremental evaluation step, record it, and return.
-
-        Progressively transforms self.eval_tree into an evaluated tree.
-        Wrap it in a list so the pattern of modififying the parent works
-        at the top level.
-        OR let's traverse the AST and add stuff as we go! (better idea)
-        Build the eval tree as we go. Make one change each time, store
-        partial evaluation information in it!
-        """
-        # We don't need no stinking recursion!
-
-
-
 #TODO: treediff two syntax trees
 
 
-def dict_of_public_methods(obj):
-    return {key: getattr(obj, key)
-            for key in dir(obj)
-            if callable(getattr(obj, key)) and not key.startswith('_')}
-
-
-import gamelib
-g = gamelib.Game()
-builtins.update(dict_of_public_methods(g))
-
-
-
-
-
 if __name__ == '__main__':
     eval((('lambda', 'x', 'y', 'z', ('+', 'x', 'y', 'z')), 1, 2, 3))
 
@@ -11,20 +11,117 @@
 
 """
 
+import hashlib
+import marshal
+import os
 import re
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+
+from debug import brief
+
+
+TOKEN = re.compile(r"""[()]|[\w\-+/*=<>?!]+|["].*?["]|['].*?[']""")
+
+
+class Symbol(str):
+    """Name to look up"""
+    __slots__ = ()
+    kind = 'symbol'
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class Text(str):
+    """String literal, spelled with its quotes, value without them"""
+    kind = 'text'
+
+    def __new__(cls, s):
+        text = str.__new__(cls, s)
+        text.value = s[1:-1]
+        return text
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class Form(tuple):
+    """Parenthesized form, with a subclass for each special form"""
+    __slots__ = ()
+    kind = 'call'
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+SPECIAL = ('do', 'fun', 'lambda', 'set', 'if', 'loop', 'while', 'for')
+FORMS = dict((name, type(name.capitalize() + 'Form', (Form,), {'__slots__': (), 'kind': name}))
+             for name in SPECIAL)
+KINDS = dict([(int, 'number'), (float, 'number'), (bool, 'number'),
+              (Symbol, 'symbol'), (Text, 'text'), (Form, 'call')] +
+             [(form, form.kind) for form in FORMS.values()])
+
+
+def dispatch(handlers):
+    """Table from node type to handlers[kind], for evaluators"""
+    return dict((t, handlers[kind]) for t, kind in KINDS.items())
+
+
+def make_form(items):
+    head = items[0] if items else None
+    return FORMS.get(head, Form)(items) if type(head) is Symbol else Form(items)
+
+
+def typed(ast):
+    """ast as parse would have returned it, for asts built or loaded
+    from somewhere else
+
+    >>> ast = typed(('if', 'x', '"a"', 2)); ast
+    ('if', 'x', '"a"', 2)
+    >>> ast.kind, ast[1].kind, ast[2].value
+    ('if', 'symbol', 'a')
+    """
+    t = type(ast)
+    if t in KINDS:
+        return ast
+    if isinstance(ast, str):
+        if len(ast) > 1 and ast[0] == ast[-1] and ast[0] in '"\'':
+            return Text(ast)
+        return Symbol(ast)
+    if isinstance(ast, (tuple, list)):
+        return make_form([typed(x) for x in ast])
+    return ast
+
+
+def plain(ast):
+    """ast with typed nodes turned back into tuples and strs, for marshal"""
+    if isinstance(ast, tuple):
+        return tuple(plain(x) for x in ast)
+    if isinstance(ast, str):
+        return str(ast)
+    if isinstance(ast, dict):
+        return dict((plain(k), plain(v)) for k, v in ast.items())
+    return ast
 
 
 class Function(namedtuple('Fun', ['name', 'params', 'ast', 'env', 'funs'])):
     """Named function, duplicate names aren't allowed"""
     def __repr__(self):
-        return 'Function(name=%s, params=(%s,), ast=%r)' % (self.name, ', '.join(self.params), self.ast)
+        return 'Function(name=%s, params=(%s,), ast=%s)' % (self.name, ', '.join(self.params), brief(self.ast))
 
 
 class Lambda(namedtuple('Lambda', ['params', 'ast', 'env', 'funs'])):
     """Lambda"""
 
 
+class Functions(dict):
+    """Functions by name, with the names in checked those whose calls by
+    name check_calls has already checked, so evaluators needn't"""
+    def __init__(self, *args, checked=()):
+        dict.__init__(self, *args)
+        self.checked = set(checked)
+
+
 def tokenize(s):
     """
 
@@ -32,14 +129,17 @@ def tokenize(s):
     ['(', '+', '(', 'thing', '1', '2', ')', '(', 'other', '3', '4', ')', ')']
 
     """
-    return re.findall(r"""[()]|[\w\-+/*=<>?!]+|["].*?["]|['].*?[']""", s)
+    return TOKEN.findall(s)
 
 
 def parse(s, i=0):
-    """Lispy syntax -> AST
+    """Lispy syntax -> AST of typed nodes: Forms, Symbols, Texts and
+    numbers, which compare and print like tuples, strs and numbers
 
     >>> parse('(+ (thing 1 2) (other 3 "4"))')
     ('+', ('thing', 1, 2), ('other', 3, '"4"'))
+    >>> type(parse('(if 1 2)')).kind
+    'if'
 
     """
     if isinstance(s, str):
@@ -54,7 +154,7 @@ def parse(s, i=0):
             except StopIteration:
                 raise ValueError("forgot to close something? %r" % (form, ))
             if f == ')':
-                return tuple(form)
+                return make_form(form)
             form.append(f)
     elif cur == ')':
         return ')'
@@ -62,8 +162,48 @@ def parse(s, i=0):
         return int(cur)
     elif re.match('[+-]?\d+\.?\d*', cur):
         return float(cur)
+    elif cur[0] == cur[-1] and cur[0] in '"\'' and len(cur) > 1:
+        return Text(cur)
     else:
-        return cur
+        return Symbol(cur)
+
+
+class Reader(object):
+    """Parses top-level forms out of text that arrives in pieces
+
+    >>> reader = Reader()
+    >>> reader.feed('(fun f x (+ x')
+    []
+    >>> reader.feed(' 1)) (f 2) f')
+    [('fun', 'f', 'x', ('+', 'x', 1)), ('f', 2)]
+    >>> reader.feed('oo ')
+    ['foo']
+    """
+    def __init__(self):
+        self.text = ''
+
+    def feed(self, text):
+        """Returns the forms completed by text, keeping any partial one"""
+        self.text += text
+        forms = []
+        depth = 0
+        end = 0
+        for match in TOKEN.finditer(self.text):
+            token = match.group()
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+                if depth < 0:
+                    self.text = ''
+                    raise ValueError('unexpected ) after %r' % (forms, ))
+            elif depth == 0 and match.end() == len(self.text):
+                break  # the rest of this atom may be in the next piece
+            if depth == 0:
+                forms.append(parse(self.text[end:match.end()]))
+                end = match.end()
+        self.text = self.text[end:]
+        return forms
 
 
 def parsed_funs(ast, map=None):
@@ -83,6 +223,134 @@ def parsed_funs(ast, map=None):
     return map
 
 
+def check_calls(ast, function_asts):
+    """Check the number of args at every call of a function by its name
+
+    Evaluators skip the check at runtime for calls like these to the
+    functions in their Functions.checked, so this also refuses params
+    and sets that would shadow a function name.
+
+    >>> ast = parse('(do (fun f x y (+ x y)) (f (f 1 2) 3))')
+    >>> check_calls(ast, parsed_funs(ast))
+    >>> check_calls(parse('(f 1)'), parsed_funs(ast))
+    Traceback (most recent call last):
+      ...
+    TypeError: func f takes 2 params, 1 args given: ('f', 1)
+    >>> check_calls(parse('(lambda f (f 1))'), parsed_funs(ast))
+    Traceback (most recent call last):
+      ...
+    ValueError: f is a function, can't also be a param or set
+
+    Names of special forms can't be used for anything else either:
+
+    >>> check_calls(parse('(fun loop n n)'), {})
+    Traceback (most recent call last):
+      ...
+    ValueError: loop is a special form, can't be a function, param, set or loop variable
+    """
+    if not isinstance(ast, tuple) or not ast:
+        return
+    head = ast[0]
+    if head in ('fun', 'lambda', 'set', 'for'):
+        names = (ast[1:-1] if head in ('fun', 'lambda') else ast[1:2])
+        for name in names:
+            if name in SPECIAL:
+                raise ValueError("%s is a special form, can't be a function, param, set or loop variable" %
+                                 (name, ))
+    if head in ('fun', 'lambda', 'set'):
+        names = ast[2:-1] if head == 'fun' else ast[1:-1] if head == 'lambda' else ast[1:2]
+        for name in names:
+            if name in function_asts:
+                raise ValueError("%s is a function, can't also be a param or set" % (name, ))
+        check_calls(ast[-1], function_asts)
+        return
+    if head == 'for' and len(ast) > 1 and ast[1] in function_asts:
+        raise ValueError("%s is a function, can't also be a loop variable" % (ast[1], ))
+    if isinstance(head, str) and head in function_asts:
+        params = len(function_asts[head]) - 3
+        if len(ast) - 1 != params:
+            raise TypeError('func %s takes %d params, %d args given: %s' %
+                            (head, params, len(ast) - 1, brief(ast)))
+    for form in ast:
+        check_calls(form, function_asts)
+
+
+PARSE_VERSION = b'2'  # change when parse or check_calls changes, so older cached parses aren't used
+
+
+class ParseCache(object):
+    """Checked parses of source, by a hash of its text and PARSE_VERSION
+
+    The size most recently used are kept in memory. With a path, parses
+    are also written there marshalled, one file per hash, so later runs
+    load them instead of parsing.
+
+    >>> cache = ParseCache(size=2)
+    >>> ast, function_asts = cache.load('(do (fun f x x) (f 1))')
+    >>> cache.load('(do (fun f x x) (f 1))')[0] is ast
+    True
+    >>> _ = cache.load('(f 2)'), cache.load('(f 3)')
+    >>> cache.load('(do (fun f x x) (f 1))')[0] is ast
+    False
+    >>> cache.hits, cache.misses
+    (1, 4)
+    """
+    def __init__(self, size=64, path=None):
+        self.size = size
+        self.path = path
+        self.parses = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, s):
+        """(ast, function_asts) for source s, checked by check_calls"""
+        key = hashlib.blake2b(PARSE_VERSION + b':' + s.encode(), digest_size=16).hexdigest()
+        parsed = self.parses.get(key)
+        if parsed is not None:
+            self.parses.move_to_end(key)
+            self.hits += 1
+            return parsed
+        self.misses += 1
+        parsed = self.read(key)
+        if parsed is None:
+            ast = parse(s)
+            function_asts = parsed_funs(ast)
+            check_calls(ast, function_asts)
+            parsed = ast, function_asts
+            self.write(key, parsed)
+        self.parses[key] = parsed
+        if len(self.parses) > self.size:
+            self.parses.popitem(last=False)
+        return parsed
+
+    def read(self, key):
+        if self.path is None:
+            return None
+        try:
+            with open(os.path.join(self.path, key + '.ast'), 'rb') as f:
+                ast, function_asts = marshal.load(f)
+            return typed(ast), dict((name, typed(x)) for name, x in function_asts.items())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def write(self, key, parsed):
+        if self.path is None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        filename = os.path.join(self.path, key + '.ast')
+        with open(filename + '.tmp', 'wb') as f:
+            marshal.dump(plain(parsed), f)
+        os.replace(filename + '.tmp', filename)
+
+
+cache = ParseCache()
+
+
+def load(s):
+    """Parse and check s, or get the parse of the same text from cache"""
+    return cache.load(s)
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
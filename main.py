@@ -1,33 +1,112 @@
 import sys
 import time
 import copy
+import threading
+from collections import deque
 
 from game import game
-from gamelib import game_methods
-from lisp_parser import parse, parsed_funs
-from obj_iter import GlobalFunctions, Runner
+from gamelib import lazy_game
+import lisp_parser
+from obj_iter import GlobalFunctions, Runner, changes
+from gen_iter import Scope
 from gamelib import builtins
+from replay import Recorder
+from repl import Server
+from scheduler import Scheduler
+from supervisor import Supervisor
+from snapshots import Adaptive
+from memo import Memo
+from timeline import Timeline
+import lisp
+import metrics
 
 
-def run_and_check(script, every=1):
-    builtins.update(game_methods())
-    env = [builtins, {}]
+class Watcher(threading.Thread):
+    """Rereads, parses and diffs a script off the main thread
+
+    Finished ChangeSets are appended to self.pending for the runner
+    to apply between steps."""
+    def __init__(self, script, ast, function_asts, every=1):
+        threading.Thread.__init__(self, daemon=True)
+        self.script = script
+        self.ast = ast
+        self.function_asts = function_asts
+        self.every = every
+        self.pending = deque()
+
+    def run(self):
+        while True:
+            time.sleep(self.every)
+            try:
+                with open(self.script) as f:
+                    s = f.read()
+                change_set = changes(s, self.ast, self.function_asts)
+            except (OSError, ValueError, TypeError, StopIteration) as e:
+                print("couldn't load %s: %r" % (self.script, e))
+                continue
+            if change_set is not None:
+                self.ast = change_set.ast
+                self.function_asts = change_set.function_asts
+                self.pending.append(change_set)
+
+
+def run_and_check(script, every=1, metrics_path=None, repl_path=None, fps=None):
+    lazy_game(builtins)
+    env = [builtins, Scope()]
     funs = GlobalFunctions()
+    funs.snapshots.policy = Adaptive()
 
     ast = open(script).read()
-    runner = Runner(ast, env, funs)
+    runner = Runner(ast, env, funs, recorder=Recorder(builtins), timeline=Timeline(), memo=Memo())
+    if metrics_path is not None:
+        metrics.instrument(runner).export(metrics_path)
 
-    last_check = time.time()
-    for value in runner:
-        if time.time() > last_check + every:
+    watcher = Watcher(script, runner.ast, runner.function_asts, every)
+    watcher.start()
+    pending = watcher.pending
+    server = None
+    if repl_path is not None:
+        server = Server(repl_path)
+        server.start()
 
-            s = open(script).read()
-            runner.update(s)
-            last_check = time.time()
+    def between():
+        while pending:
+            runner.apply(pending.popleft())
+        if server is not None and server.pending:
+            server.answer(runner)
+
+    if fps is not None:
+        scheduler = Scheduler(runner, fps)
+        value = scheduler.run(between)
+        print('%d frames, %d dropped' % (scheduler.frames, scheduler.dropped))
+        return value
+    for value in runner:
+        between()
 
     return value
 
 
+def run_workers(script, workers, every=1):
+    """Run the script in several processes that share one parse of it"""
+    lazy_game(builtins)
+    supervisor = Supervisor(open(script).read(), workers)
+    supervisor.start()
+    while any(process.is_alive() for process in supervisor.processes):
+        time.sleep(every)
+        try:
+            supervisor.reload(open(script).read())
+        except (ValueError, TypeError, StopIteration) as e:
+            print("couldn't load %s: %r" % (script, e))
+    supervisor.stop()
+
+
+def run_batch(script):
+    """Run a script once on the fast evaluator, without watching it"""
+    lazy_game(builtins)
+    ast, function_asts = lisp_parser.load(open(script).read())
+    return lisp.eval(ast, [builtins, {}], lisp_parser.Functions(checked=function_asts))
+
+
 test = """
 (do
     (fun each i (do
@@ -39,6 +118,29 @@ test = """
 """
 
 if __name__ == '__main__':
+    batch = '--batch' in sys.argv
+    if batch:
+        sys.argv.remove('--batch')
+    metrics_path = None
+    repl_path = None
+    workers = None
+    fps = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('--metrics='):
+            metrics_path = arg[len('--metrics='):]
+            sys.argv.remove(arg)
+        elif arg.startswith('--repl='):
+            repl_path = arg[len('--repl='):]
+            sys.argv.remove(arg)
+        elif arg.startswith('--workers='):
+            workers = int(arg[len('--workers='):])
+            sys.argv.remove(arg)
+        elif arg.startswith('--fps='):
+            fps = int(arg[len('--fps='):])
+            sys.argv.remove(arg)
+        elif arg.startswith('--parse-cache='):
+            lisp_parser.cache.path = arg[len('--parse-cache='):]
+            sys.argv.remove(arg)
     if len(sys.argv) == 1:
         script = 'tmp.scm'
         open(script, 'w').write(game)
@@ -46,5 +148,11 @@ if __name__ == '__main__':
         script = sys.argv[1]
     print(script)
 
-    print('watching %s for changes...' % (script, ))
-    run_and_check(script)
+    if batch:
+        print(run_batch(script))
+    elif workers is not None:
+        print('running %d workers on %s...' % (workers, script))
+        run_workers(script, workers)
+    else:
+        print('watching %s for changes...' % (script, ))
+        run_and_check(script, metrics_path=metrics_path, repl_path=repl_path, fps=fps)
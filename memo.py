@@ -0,0 +1,143 @@
+"""
+Remembered results of calls to pure user functions
+
+A function is taken to be pure if all it calls are pure builtins and
+other pure user functions; functions only see their own arguments, so
+that's all it takes. A call to one with arguments it has been called
+with before returns the remembered value instead of running the body,
+saving every step the body would have taken.
+
+>>> from obj_iter import Runner
+>>> src = '''(do (fun sq x (* x x))
+...               (fun sum-sq n (if (< n 1) 0 (+ (sq 3) (sum-sq (- n 1)))))
+...               (sum-sq 20))'''
+>>> r = Runner(src, memo=Memo())
+>>> sorted(r.funs.memo.pure)
+['sq', 'sum-sq']
+>>> for value in r: pass
+>>> value, r.funs.memo.hits
+(180, 19)
+
+Changing a function forgets what was remembered for it and for every
+function that calls it:
+
+>>> r.funs.memo.update(r.function_asts, {'sq'})
+>>> len(r.funs.memo)
+0
+"""
+from collections import OrderedDict
+
+from lisp_parser import typed
+
+
+PURE = ['+', '-', '*', '/', '=', '<', '>', 'list', 'len', 'width', 'height']
+
+
+def calls(function_asts):
+    """Names each function calls directly, and whether it does anything
+    that can't be pure: defining functions, or calling a value that
+    isn't named"""
+    direct = {}
+    unsafe = set()
+    for name, fun_ast in function_asts.items():
+        fun_ast = typed(fun_ast)
+        params = set(fun_ast[2:-1])
+        heads = direct[name] = set()
+        todo = [fun_ast[-1]]
+        while todo:
+            ast = todo.pop()
+            kind = getattr(ast, 'kind', None)
+            if kind in ('fun', 'lambda'):
+                unsafe.add(name)
+            elif kind == 'call':
+                head = ast[0]
+                if getattr(head, 'kind', None) != 'symbol' or head in params:
+                    unsafe.add(name)
+                else:
+                    heads.add(head)
+            if isinstance(ast, tuple):
+                todo.extend(ast)
+    return direct, unsafe
+
+
+class Memo(object):
+    """Results of calls to pure functions, the size most recently used
+
+    pure names the functions to remember calls to, or None to work it
+    out from their asts."""
+    def __init__(self, size=4096, pure=None):
+        self.size = size
+        self.declared = pure
+        self.pure = set()
+        self.callees = {}  # name -> user functions it calls, directly or not
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, function_asts, changed=()):
+        """Work out which functions are pure, forgetting results of calls
+        to changed functions and to anything that calls them"""
+        direct, unsafe = calls(function_asts)
+        old = self.callees
+        self.callees = {}
+        for name in direct:
+            seen = set()
+            todo = [name]
+            while todo:
+                for callee in direct.get(todo.pop(), ()):
+                    if callee in direct and callee not in seen:
+                        seen.add(callee)
+                        todo.append(callee)
+            self.callees[name] = seen
+
+        if self.declared is not None:
+            self.pure = set(self.declared) & set(direct)
+        else:
+            pure = set(direct) - unsafe
+            while True:
+                impure = set(name for name in pure
+                             if any(head not in pure and head not in PURE for head in direct[name]))
+                if not impure:
+                    break
+                pure -= impure
+            self.pure = pure
+
+        changed = set(changed)
+        stale = set(changed)
+        for callees in (old, self.callees):
+            stale |= set(name for name, names in callees.items() if names & changed)
+        stale |= set(name for name, _, _ in self.values) - self.pure
+        if stale:
+            for key in [key for key in self.values if key[0] in stale]:
+                del self.values[key]
+
+    def key(self, name, args):
+        """Key for a call, or None if it can't be remembered"""
+        if name not in self.pure:
+            return None
+        args = tuple(args)
+        key = (name, args, tuple(type(arg) for arg in args))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def __contains__(self, key):
+        if key in self.values:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def __getitem__(self, key):
+        self.values.move_to_end(key)
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+        if len(self.values) > self.size:
+            self.values.popitem(last=False)
+
+    def __len__(self):
+        return len(self.values)
@@ -0,0 +1,240 @@
+"""
+Counters and histograms for a running Runner, exported as text in the
+Prometheus exposition format to a file or a Unix socket
+
+>>> registry = Registry()
+>>> steps = registry.counter('steps_total', 'Interpreter steps')
+>>> steps.inc(3)
+>>> latency = registry.histogram('call_seconds', 'Call time', buckets=[.1, 1])
+>>> latency.observe(.5)
+>>> print(registry.exposition(), end='')
+# HELP dast_steps_total Interpreter steps
+# TYPE dast_steps_total counter
+dast_steps_total 3
+# HELP dast_call_seconds Call time
+# TYPE dast_call_seconds histogram
+dast_call_seconds_bucket{le="0.1"} 0
+dast_call_seconds_bucket{le="1"} 1
+dast_call_seconds_bucket{le="+Inf"} 1
+dast_call_seconds_sum 0.5
+dast_call_seconds_count 1
+"""
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+
+
+TIMES = [.00001, .0001, .001, .005, .01, .025, .05, .1, .25, .5, 1, 5]
+
+
+class Counter(object):
+    """Counted directly, or read from a function when exported"""
+    kind = 'counter'
+
+    def __init__(self, name, help, read=None):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        yield self.name, self.value if self.read is None else self.read()
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=TIMES):
+        self.name = name
+        self.help = help
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            total += count
+            yield '%s_bucket{le="%s"}' % (self.name, bound), total
+        yield self.name + '_sum', self.sum
+        yield self.name + '_count', self.count
+
+
+class Registry(object):
+    def __init__(self, prefix='dast_'):
+        self.prefix = prefix
+        self.metrics = []
+
+    def add(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, read=None):
+        return self.add(Counter(name, help, read))
+
+    def gauge(self, name, help, read=None):
+        return self.add(Gauge(name, help, read))
+
+    def histogram(self, name, help, buckets=TIMES):
+        return self.add(Histogram(name, help, buckets))
+
+    def exposition(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, value in metric.samples():
+                lines.append('%s %r' % (name, value))
+        return ''.join(line + '\n' for line in lines)
+
+    def write(self, path):
+        """Replace the file at path with the current values"""
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.exposition())
+        os.replace(path + '.tmp', path)
+
+    def export(self, path, every=5):
+        """Keep a Unix socket (if path ends in .sock) or a text file at
+        path up to date from a background thread"""
+        if path.endswith('.sock'):
+            target = self.serve
+        else:
+            def target(path):
+                while True:
+                    self.write(path)
+                    time.sleep(every)
+        thread = threading.Thread(target=target, args=(path, ), daemon=True)
+        thread.start()
+        return thread
+
+    def serve(self, path):
+        """Answer every connection to a Unix socket with the current values"""
+        if os.path.exists(path):
+            os.remove(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(5)
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                conn.sendall(self.exposition().encode())
+
+
+def instrument(runner, registry=None, sample=64):
+    """Collect metrics about runner, which hasn't started stepping yet,
+    into registry or a new Registry, which is returned
+
+    Step time is measured on one step in every sample; everything else
+    is counted as it happens.
+
+    >>> from obj_iter import Runner
+    >>> a, b = instrument(Runner('(+ 1 2)')), instrument(Runner('(+ 1 2)'))
+    >>> a is b, len(a.metrics) == len(b.metrics)
+    (False, True)
+
+    Reloads are counted by how they were handled:
+
+    >>> from lisp_parser import parse
+    >>> src = '(do (fun f x (* x 2)) (set a (f 1)) (set m 0) (while (< m 9) (set m (+ m 1))) a)'
+    >>> r = Runner(src)
+    >>> registry = instrument(r)
+    >>> while r.env[-1].get('m', 0) < 5: r.step()
+    >>> r.update(src.replace('(* x 2)', '(* x 3)'))  # doctest: +ELLIPSIS
+    ast changed!
+    ast modified! changed function {'f'}
+    restoring snapshot from ...
+    >>> print(registry.exposition(), end='')  # doctest: +ELLIPSIS
+    # HELP ...
+    dast_restored_snapshots_total 1
+    ...
+    """
+    if registry is None:
+        registry = Registry()
+    funs = runner.funs
+    snapshots = funs.snapshots
+
+    steps = registry.counter('steps_total', 'Interpreter steps taken, including reruns after a rollback')
+    registry.gauge('step', 'Current step number, which goes back on a rollback or seek', lambda: runner.i)
+    step_seconds = registry.histogram('step_seconds', 'Time taken by sampled Runner.step calls')
+    registry.gauge('snapshots', 'Snapshots currently saved', lambda: len(snapshots))
+    registry.gauge('snapshot_bytes', 'Approximate size of the snapshot store',
+                   lambda: snapshots.store.bytes)
+    call_seconds = registry.histogram('about_to_call_seconds', 'Time spent snapshotting before calls')
+    update_seconds = registry.histogram('update_seconds', 'Time taken to apply a change set')
+    last_reload = registry.gauge('last_reload_timestamp_seconds', 'When code was last reloaded')
+    restarts = registry.counter('restarted_calls_total', 'Reloads handled by restarting a live call')
+    restores = registry.counter('restored_snapshots_total', 'Reloads handled by restoring a snapshot')
+    frame_seconds = registry.histogram('frame_seconds', 'Time between calls to render')
+
+    step, about_to_call, apply = runner.step, funs.about_to_call, runner.apply
+    restart_call, restore = runner.restart_call, snapshots.restore
+
+    def timed_step():
+        steps.inc()
+        if runner.i % sample:
+            return step()
+        t = time.perf_counter()
+        value = step()
+        step_seconds.observe(time.perf_counter() - t)
+        return value
+
+    def timed_about_to_call(func):
+        t = time.perf_counter()
+        start = about_to_call(func)
+        call_seconds.observe(time.perf_counter() - t)
+        return start
+
+    def timed_apply(change_set):
+        t = time.perf_counter()
+        apply(change_set)
+        update_seconds.observe(time.perf_counter() - t)
+        last_reload.set(time.time())
+
+    def counted_restart_call(names):
+        since = restart_call(names)
+        if since is not None:
+            restarts.inc()
+        return since
+
+    def counted_restore(*args):
+        restores.inc()
+        return restore(*args)
+
+    last_frame = [None]
+
+    def timed_render(render):
+        def rendered(*args):
+            value = render(*args)
+            t = time.perf_counter()
+            if last_frame[0] is not None:
+                frame_seconds.observe(t - last_frame[0])
+            last_frame[0] = t
+            return value
+        return rendered
+
+    runner.step = timed_step
+    funs.about_to_call = timed_about_to_call
+    runner.apply = timed_apply
+    runner.restart_call = counted_restart_call
+    snapshots.restore = counted_restore
+    runner.wrap('render', timed_render)
+    return registry
@@ -19,11 +19,15 @@ Literal("a")
 """
 import copy
 import time
+from collections import namedtuple
 
-from gamelib import builtins
-from lisp_parser import parse, Function, Lambda, parsed_funs
+from gamelib import builtins, PyFuncs
+from lisp_parser import parse, load, typed, make_form, dispatch, Function, Functions, Lambda, parsed_funs, check_calls
 
-from gen_iter import literal, lookup, setbang
+from gen_iter import literal, lookup, setbang, Scope
+from snapshots import Snapshots
+from debug import brief
+from limits import LimitExceeded
 
 
 class Incomplete():
@@ -33,11 +37,30 @@ class Incomplete():
 Incomplete = Incomplete()
 
 
-class GlobalFunctions(dict):
+FORGET_EVERY = 1024  # steps between dropping input nothing can replay
+PUSH_STEPS = 100000  # most steps a pushed expression may take
+
+
+class GlobalFunctions(Functions):
     # TODO put this logic in Runner instead
     def __init__(self):
-        dict.__init__(self)
-        self.snapshots = {}
+        Functions.__init__(self)
+        self.snapshots = Snapshots()
+        self.calls = 0
+        self.last_called = {}
+        self.step = 0
+        self.depth = 0  # live Frames
+        self.meter = None  # limits.Limits counting env bytes, if any
+        self.effects = {}  # global name -> functions its value came from
+        self.memo = None  # memo.Memo of pure function results, if any
+
+    def wrote(self, symbol, calls, reads, scope):
+        """Remember the functions called while working out the value just
+        set as a global, and those of the globals read for it"""
+        names = set(name for name, n in self.last_called.items() if n > calls)
+        for read in scope.read_since(reads):
+            names |= self.effects.get(read, set())
+        self.effects[symbol] = names
 
     def set_eval_tree(self, tree):
         self.top_level = tree
@@ -46,7 +69,21 @@ class GlobalFunctions(dict):
         if not isinstance(func, (Function, Lambda)):
             raise ValueError('?')
         t = time.time()
-        self.snapshots[func.name] = [copy.deepcopy(self.top_level), t]
+        self.snapshots.about_to_call(func.name, self.top_level, t, self.step)
+        return self.called(func.name)
+
+    def called(self, name):
+        """Number a call so frames can tell what has run since they started"""
+        self.calls += 1
+        self.last_called[name] = self.calls
+        return self.calls
+
+    def remembered(self, name):
+        """A call answered from memo, which counts as a call to everything
+        it would have called too"""
+        for callee in self.memo.callees.get(name, ()):
+            self.called(callee)
+        return self.called(name)
 
     def __getitem__(self, key):
         fun = dict.__getitem__(self, key)
@@ -56,6 +93,91 @@ class GlobalFunctions(dict):
         return self
 
 
+ChangeSet = namedtuple('ChangeSet', ['ast', 'function_asts', 'new', 'removed', 'modified'])
+
+
+def diff_funs(old_funs, new_funs):
+    """Returns new, removed, and modified function names"""
+    return (set(new_funs) - set(old_funs),
+            set(old_funs) - set(new_funs),
+            set(name for name in new_funs
+                if name in old_funs and new_funs[name] != old_funs[name]))
+
+
+def changes(s, old_ast, old_function_asts):
+    """Parse and diff new source (or an ast parsed elsewhere) against an
+    old parse, None if unchanged
+
+    Doesn't touch any Runner, so it can run on a background thread.
+    Calls with the wrong number of args are errors here, before any
+    rollback.
+
+    >>> old = parse('(do (fun f x x) (fun g 1) (f 1))')
+    >>> c = changes('(do (fun f x (+ x 1)) (fun h 2) (f 1))', old, parsed_funs(old))
+    >>> c.new, c.removed, c.modified
+    ({'h'}, {'g'}, {'f'})
+    >>> changes('(do (fun f x x) (fun g 1) (f 1))', old, parsed_funs(old))
+    """
+    if isinstance(s, str):
+        ast, function_asts = load(s)
+        if ast == old_ast:
+            return None
+    else:
+        ast = s
+        if ast == old_ast:
+            return None
+        function_asts = parsed_funs(ast)
+        check_calls(ast, function_asts)
+    return ChangeSet(ast, function_asts, *diff_funs(old_function_asts, function_asts))
+
+
+def replace_fun(ast, form):
+    """ast with the definition of the function form defines swapped for it
+
+    >>> replace_fun(('do', ('fun', 'f', 1), ('f',)), ('fun', 'f', 2))
+    ('do', ('fun', 'f', 2), ('f',))
+    """
+    if not isinstance(ast, tuple):
+        return ast
+    if ast[:1] == ('fun', ) and ast[1] == form[1]:
+        return typed(form)
+    return make_form([replace_fun(x, form) for x in ast])
+
+
+def outside_funs(ast):
+    """ast without function definitions, to tell whether anything
+    besides functions changed
+
+    >>> outside_funs(parse('(do (fun f x (+ x 1)) (f 2))'))
+    ('do', ('f', 2))
+    """
+    if not isinstance(ast, tuple):
+        return ast
+    return tuple(outside_funs(x) for x in ast if not (isinstance(x, tuple) and x[:1] == ('fun', )))
+
+
+def pending_sets(tree):
+    """Names that set and for forms yet to run in tree could set
+
+    >>> pending_sets(Do(parse('((set a 1) (while 1 (set b 2)))'), [{}], {}))
+    ['a', 'b']
+    """
+    names = set()
+    todo = [tree]
+    while todo:
+        x = todo.pop()
+        if isinstance(x, Do):
+            todo.extend(x.forms[len(x.values):])
+            todo.append(x.delegate)
+        elif isinstance(x, BaseEval):
+            todo.extend(v for k, v in x.__dict__.items() if k not in ('env', 'funs'))
+        elif isinstance(x, tuple):
+            if len(x) > 1 and x[0] in ('set', 'for'):
+                names.add(x[1])
+            todo.extend(x)
+    return sorted(names)
+
+
 def run(s, env=None, funs=None):
     """
     >>> run('(+ 1 1)')
@@ -68,70 +190,433 @@ def run(s, env=None, funs=None):
 
 
 class Runner(object):
-    def __init__(self, s, env=None, funs=None):
-        self.ast = parse(s)
-        self.function_asts = parsed_funs(self.ast)
+    """Steps through a program, swapping in new code as it changes
+
+    With a replay.Recorder, impure builtin results are logged so that
+    after a rollback the program is fast-forwarded back to the present
+    with the new code instead of resuming from the rollback point.
+
+    s is source, or an ast that has already been parsed.
+    """
+    def __init__(self, s, env=None, funs=None, recorder=None, timeline=None, limits=None, memo=None):
+        if isinstance(s, str):
+            self.ast, self.function_asts = load(s)
+        else:
+            self.ast = s
+            self.function_asts = parsed_funs(self.ast)
+            check_calls(self.ast, self.function_asts)
         self.done = False
         self.i = 0
 
         if env is None:
-            env = [builtins, {}]
+            env = [builtins, Scope()]
         if funs is None:
             funs = GlobalFunctions()
-
+        if recorder is not None:
+            env = env[:-1] + [recorder, env[-1]]
+            recorder.clock = self
+
+        self.recorder = recorder
+        self.timeline = timeline
+        self.limits = limits
+        if limits is not None:
+            funs.meter = limits
+            limits.meter(env[-1])
+        if isinstance(env[-1], Scope):
+            env[-1].track_reads()
+        if memo is not None:
+            funs.memo = memo
+            memo.update(self.function_asts)
+        funs.checked = set(self.function_asts)
+        self.env = env
         self.funs = funs
         self.state = Eval(self.ast, env, funs)
         funs.set_eval_tree(self.state)
         self.orig_eval = copy.deepcopy(self.state)
 
     def reset(self):
+        """Start the program over, with fresh globals that become the live ones
+
+        >>> src = '(do (set speed 1) (set m 0) (while (< m 50) (set m (+ m 1))) (list speed m))'
+        >>> r = Runner(src)
+        >>> for _ in range(100): r.step()
+        >>> r.update(src.replace('50', '60'))
+        ast changed!
+        >>> while 'm' not in r.env[-1]: r.step()
+        >>> r.push(parse('(set speed 5)'))
+        5
+        >>> for value in r: pass
+        >>> value
+        (5, 60)
+        """
         self.state = copy.deepcopy(self.orig_eval)
+        self.adopt(self.state.env[-1])
+        self.funs.set_eval_tree(self.state)
+        self.recount()
+
+    def recount(self):
+        """Count live frames and their env bytes again after the tree
+        was swapped out for a different one"""
+        self.funs.depth = 0
+        scopes = [self.env[-1]]
+        for _, _, frame in self.live_frames():
+            self.funs.depth += 1
+            scopes.append(frame.env[-1])
+        if self.limits is not None:
+            self.limits.bytes = 0
+            for scope in scopes:
+                if isinstance(scope, Scope):
+                    scope.meter = None
+                    self.limits.meter(scope)
+
+    def wrap(self, name, make):
+        """Replace the builtin name with make(previous), where previous
+        calls whatever name was before, in a layer just under the globals
+
+        >>> r = Runner('(+ 1 2)')
+        >>> calls = []
+        >>> r.wrap('+', lambda previous: lambda *args: calls.append(args) or previous(*args))
+        >>> for value in r: pass
+        >>> value, calls
+        (3, [(1, 2)])
+        """
+        below = self.env[:-1]
+
+        def previous(*args):
+            return lookup(name, below)(*args)
+
+        layer = PyFuncs({name: make(previous)})
+        self.env.insert(-1, layer)
+        self.orig_eval.env.insert(-1, layer)
+
+    def kill(self):
+        """Stop for good, letting go of the tree"""
+        self.done = True
+        self.state = None
+        self.funs.set_eval_tree(None)
 
     def diff_funs(self, old_funs, new_funs):
         """Returns new, removed, and modified function names"""
-        return (set(new_funs) - set(old_funs),
-                set(old_funs) - set(new_funs),
-                set(name for name in new_funs
-                    if new_funs[name] != old_funs[name]))
+        return diff_funs(old_funs, new_funs)
 
     def update(self, s):
-        ast = parse(s)
+        """Swap in new source, rolling back as little as possible
+
+        New and removed functions are installed directly. The outermost
+        live call that depends on a changed or removed function is
+        restarted in place; otherwise the earliest snapshot taken before
+        a call to a modified function is restored, keeping the live
+        values of globals that didn't come from a changed function.
+
+        >>> src = '''(do (fun inc x (+ x 1))
+        ...               (fun count x (if (< x 100) (count (inc x)) x))
+        ...               (count 0))'''
+        >>> r = Runner(src)
+        >>> for _ in range(300): r.step()
+        >>> r.update(src.replace('(+ x 1)', '(+ x 10)'))
+        ast changed!
+        ast modified! changed function {'inc'}
+        restarting call to count
+        >>> r.state.name, r.state.args
+        ('count', (8,))
+        >>> for value in r: pass
+        >>> value
+        108
+
+        >>> r = Runner(src)
+        >>> for _ in range(300): r.step()
+        >>> r.update(src.replace('(+ x 1)', '(double x)').replace(
+        ...     '(fun count', '(fun double x (* x 2)) (fun count'))
+        ast changed!
+        ast modified! changed function {'inc'}
+        restarting call to count
+        >>> for value in r: pass
+        >>> value
+        128
+
+        A change outside any function starts the program over, with
+        whatever functions changed along with it:
+
+        >>> src = '(do (fun f x (* x 2)) (set m 0) (while (< m 50) (set m (+ m 1))) (list (f 1) 111))'
+        >>> r = Runner(src)
+        >>> for _ in range(100): r.step()
+        >>> r.update(src.replace('(* x 2)', '(* x 3)').replace('111', '222'))
+        ast changed!
+        ast modified! changed function {'f'}
+        >>> for value in r: pass
+        >>> value
+        (3, 222)
+        """
+        change_set = changes(s, self.ast, self.function_asts)
+        if change_set is not None:
+            self.apply(change_set)
+
+    def push(self, form, budget=PUSH_STEPS):
+        """Define a function or evaluate an expression sent while running
+
+        A fun form replaces that one function as if its source had been
+        edited; anything else is evaluated to completion in the global
+        environment, between steps, unless it takes more than budget
+        steps. Returns the function name or the value.
+
+        >>> r = Runner('(do (fun inc x (+ x 1)) (set n 0) (inc n))')
+        >>> while 'n' not in r.env[-1]: r.step()
+        >>> r.push(parse('(fun inc x (+ x 2))'))
+        ast changed!
+        ast modified! changed function {'inc'}
+        'inc'
+        >>> r.push(parse('(set n 10)'))
+        10
+        >>> for value in r: pass
+        >>> value
+        12
+        >>> r.push(parse('(inc 1 2)'))
+        Traceback (most recent call last):
+          ...
+        TypeError: func inc takes 1 params, 2 args given: ('inc', 1, 2)
+        >>> r.push(parse('(while 1 0)'), budget=50)
+        Traceback (most recent call last):
+        ...
+        limits.LimitExceeded: steps 50 is over the limit of 50
+        """
+        if not (isinstance(form, tuple) and form[:1] == ('fun', )):
+            defined = parsed_funs(form)
+            check_calls(form, dict(self.function_asts, **defined))
+            self.funs.checked -= set(defined)
+            tree = Eval(form, self.env, self.funs)
+            for _ in range(budget):
+                value = next(tree)
+                if isinstance(value, BaseEval):
+                    tree = value
+                elif value is not Incomplete:
+                    return value
+            raise LimitExceeded('steps', budget, budget)
+        name = form[1]
+        if self.function_asts.get(name) != form:
+            function_asts = dict(self.function_asts)
+            function_asts[name] = form
+            ast = replace_fun(self.ast, form)
+            check_calls(ast, function_asts)
+            self.apply(ChangeSet(ast, function_asts, *diff_funs(self.function_asts, function_asts)))
+        elif name not in self.funs:
+            self.define(form)
+        return name
+
+    def define(self, fun_ast):
+        name = fun_ast[1]
+        self.funs[name] = Function(name=name, params=fun_ast[2:-1], ast=fun_ast[-1],
+                                   env=self.env, funs=self.funs)
+
+    def apply(self, change_set):
+        """Install a ChangeSet prepared by changes(), between steps
+
+        It is diffed again against what's running, which push may have
+        changed since the ChangeSet was made, so the file wins:
+
+        >>> src = '(do (fun inc x (+ x 1)) (fun dec x (- x 1)) (set n 0) (inc n))'
+        >>> r = Runner(src)
+        >>> base = r.ast, r.function_asts
+        >>> while 'n' not in r.env[-1]: r.step()
+        >>> r.push(parse('(fun inc x (+ x 5))'))
+        ast changed!
+        ast modified! changed function {'inc'}
+        'inc'
+        >>> r.apply(changes(src.replace('(- x 1)', '(- x 2)'), *base))  # doctest: +ELLIPSIS
+        ast changed!
+        ast modified! changed function ...
+        >>> sorted(r.funs.checked), r.function_asts['inc'][-1] == r.funs['inc'].ast
+        (['dec', 'inc'], True)
+        >>> for value in r: pass
+        >>> value
+        1
+        """
+        ast, new_fun_asts = change_set.ast, change_set.function_asts
         if ast == self.ast:
             return
+        new, removed, modified = diff_funs(self.function_asts, new_fun_asts)
         print('ast changed!')
-
-        new_fun_asts = parsed_funs(ast)
-        new, removed, modified = self.diff_funs(self.function_asts, new_fun_asts)
+        top_level_changed = outside_funs(ast) != outside_funs(self.ast)
         self.function_asts = new_fun_asts
+        self.funs.checked = set(new_fun_asts)
         self.ast = ast
+        self.orig_eval.ast = ast
         if modified:
             print('ast modified! changed function %s' % (modified, ))
-        if new or removed or len(modified) > 1:
-            raise ValueError("can't cope with that change yet: new:%r removed:%r modified:%r" % (new, removed, modified))
+        if self.funs.memo is not None:
+            self.funs.memo.update(new_fun_asts, removed | modified)
 
-        if modified:
-            (name, ) = modified
+        for name in removed:
+            self.funs.pop(name, None)
+            self.funs.snapshots.pop(name, None)
+        for name in new | modified:
+            self.define(new_fun_asts[name])
 
-            old = self.funs[name]
-            function = Function(name=old.name,
-                                params=new_fun_asts[name][2:-1],
-                                ast=new_fun_asts[name][-1],
-                                env=old.env,
-                                funs=old.funs)
-            self.funs[name] = function
+        if top_level_changed:
+            self.reset()
+            return
 
-            if name not in self.funs.snapshots:
+        changed = removed | modified
+        if not changed:
+            return
+        since = self.restart_call(changed)
+        if since is None:
+            saved = [self.funs.snapshots[name] for name in modified
+                     if name in self.funs.snapshots]
+            if not saved:
                 return
-            snapshot, t = self.funs.snapshots[name]
-            print('restoring snapshot from %s' % (t, ))
-            self.state = snapshot
-            self.funs.set_eval_tree(self.state)
-        else:  # must have been in top level expression
-            self.state = self.orig_eval
+            snapshot = min(saved, key=lambda saved: saved.t)
+            print('restoring snapshot from %s' % (snapshot.t, ))
+            scopes = {}
+            self.state = self.funs.snapshots.restore(snapshot, scopes)
+            self.merge_forward(scopes, changed)
+            since = snapshot.step
             self.funs.set_eval_tree(self.state)
+        self.recount()
+        self.catch_up(since)
+
+    def merge_forward(self, scopes, changed):
+        """Carry live globals over to the restored global scope, which
+        becomes the live one, unless a changed function went into them
+        or the restored tree will set them again as it reruns
+
+        Globals set between steps, as by push, keep their live values:
+
+        >>> src = '''(do (fun f x (* x 2)) (set speed 1) (set a (f 1)) (set m 0)
+        ...               (while (< m 100) (set m (+ m 1))) (list a speed m))'''
+        >>> r = Runner(src)
+        >>> while r.env[-1].get('m', 0) < 50: r.step()
+        >>> r.push(parse('(set speed 5)'))
+        5
+        >>> r.update(src.replace('(* x 2)', '(* x 3)'))  # doctest: +ELLIPSIS
+        ast changed!
+        ast modified! changed function {'f'}
+        restoring snapshot from ...
+        >>> sorted(r.env[-1].items())
+        [('speed', 5)]
+        >>> for value in r: pass
+        >>> value
+        (3, 5, 100)
+
+        and sets that will run again don't run twice over:
+
+        >>> src = '''(do (fun f x (* x 2)) (set k 0) (set a (f 1)) (set k (+ k 1))
+        ...               (set k (+ k 1)) (set m 0) (while (< m 100) (set m (+ m 1))) (list a k))'''
+        >>> r = Runner(src)
+        >>> while r.env[-1].get('m', 0) < 50: r.step()
+        >>> r.update(src.replace('(* x 2)', '(* x 3)'))  # doctest: +ELLIPSIS
+        ast changed!
+        ast modified! changed function {'f'}
+        restoring snapshot from ...
+        >>> for value in r: pass
+        >>> value
+        (3, 2)
+        """
+        live = self.env[-1]
+        restored = scopes.get(getattr(live, 'uid', None))
+        if restored is None:
+            return
+        affected = set(name for name, names in self.funs.effects.items() if names & changed)
+        affected.update(pending_sets(self.state))
+        for key, value in live.vars.items():
+            if key not in affected:
+                restored[key] = value
+        restored.read_at, restored.reads = live.read_at, live.reads
+        self.env[-1] = restored
+
+    def adopt(self, scope):
+        """Make scope, the global scope of a tree just swapped in, the
+        live one, going on counting reads from where the old one was"""
+        live = self.env[-1]
+        if getattr(live, 'read_at', None) is not None:
+            scope.track_reads()
+            scope.reads = live.reads
+        self.env[-1] = scope
+
+    def catch_up(self, since, until=None):
+        """Rerun from step since back to the present, or on to step until,
+        on recorded input"""
+        if self.recorder is None and until is None:
+            return
+        until = self.i if until is None else until
+        self.i = since - 1
+        if self.timeline is not None:
+            self.timeline.truncate(self.i)
+        if self.recorder is not None:
+            self.recorder.replay(since)
+        try:
+            while self.i < until and not self.done:
+                self.step()
+        finally:
+            if self.recorder is not None:
+                self.recorder.stop()
+
+    def seek(self, step):
+        """Go back to just after step, from the keyframe before it
+
+        What happened after step is forgotten: running on from there
+        takes fresh input, and snapshots from later on are dropped.
+        The keyframe's globals become the live ones:
+
+        >>> from timeline import Timeline
+        >>> src = '(do (set speed 1) (set m 0) (while (< m 50) (set m (+ m 1))) (list speed m))'
+        >>> r = Runner(src, timeline=Timeline(every=10))
+        >>> for _ in range(200): r.step()
+        >>> r.seek(100)
+        >>> r.push(parse('(set speed 5)'))
+        5
+        >>> for value in r: pass
+        >>> value
+        (5, 50)
+        """
+        keyframe = self.timeline.before(step)
+        if keyframe is None:
+            raise ValueError('no keyframe at or before step %d' % (step, ))
+        for name in [name for name, snapshot in self.funs.snapshots.saved.items()
+                     if snapshot.step > keyframe.step]:
+            self.funs.snapshots.pop(name)
+        scopes = {}
+        self.state = self.timeline.restore(keyframe, scopes)
+        restored = scopes.get(getattr(self.env[-1], 'uid', None))
+        if restored is not None:
+            self.adopt(restored)
+        self.funs.set_eval_tree(self.state)
+        self.recount()
+        self.done = False
+        self.catch_up(keyframe.step + 1, until=step)
+
+    def live_frames(self):
+        """Frames on the path being evaluated, outermost first
+
+        Yields (owner, attribute, frame) so a frame can be swapped out."""
+        owner, attr, node = self, 'state', self.state
+        while node is not None:
+            if isinstance(node, Frame):
+                yield owner, attr, node
+            owner, attr, node = node, 'delegate', getattr(node, 'delegate', None)
+
+    def restart_call(self, names):
+        """Rerun the outermost live call that depends on any of names
+
+        Callers of that call keep their progress and their environments.
+        Returns the step the call originally started at, or None if no
+        live call depends on names and a snapshot is needed instead.
+        """
+        for owner, attr, frame in self.live_frames():
+            if frame.depends_on(names):
+                new = frame.restart()
+                if new is None:
+                    return None
+                print('restarting call to %s' % (frame.name, ))
+                setattr(owner, attr, new)
+                self.funs.set_eval_tree(self.state)
+                return frame.step
+        return None
 
     def step(self):
+        if self.limits is not None:
+            self.limits.check(self)
         self.i += 1
+        self.funs.step = self.i
         value = next(self.state)
         if value is Incomplete:
             pass
@@ -141,6 +626,27 @@ class Runner(object):
         else:
             self.done = True
             return value
+        if self.timeline is not None and self.timeline.due(self.i):
+            self.timeline.record(self.state, time.time(), self.i)
+        if self.recorder is not None and self.i % FORGET_EVERY == 0:
+            self.forget()
+
+    def forget(self):
+        """Drop recorded input from before the oldest snapshot and keyframe,
+        which no rollback or seek can go back past
+
+        >>> from replay import Recorder
+        >>> r = Runner('(do (fun f x (coinflip)) (f 1) (f 2) (f 3))', recorder=Recorder(builtins))
+        >>> for value in r: pass
+        >>> len(r.recorder.logs['coinflip'][1])
+        3
+        >>> r.forget(); len(r.recorder.logs['coinflip'][1])
+        1
+        """
+        steps = [snapshot.step for snapshot in self.funs.snapshots.saved.values()]
+        if self.timeline is not None and len(self.timeline):
+            steps.append(self.timeline.steps[0])
+        self.recorder.forget(min(steps) if steps else self.i)
 
     def __iter__(self):
         return self
@@ -177,33 +683,20 @@ class Eval(BaseEval):
         self.funs = funs
 
     def __repr__(self):
-        return "Eval(%r, env=%r, funs=%r)" % (self.ast, self.env, self.funs)
+        return "Eval(%s, env=%s, funs=%s)" % (brief(self.ast), brief(self.env), brief(self.funs))
 
     def __next__(self):
         return eval(self.ast, self.env, self.funs)
 
 
 def eval(ast, env, funs):
-    if isinstance(ast, (int, float)):
-        return Literal(ast)
-    if isinstance(ast, str):
-        start, end = ast[0], ast[-1]
-        if start == end and start in ["'", '"']:
-            return Literal(ast)
-        return Lookup(ast, env, funs)
-    if not isinstance(ast, (list, tuple)):
-        raise ValueError(ast, env, funs)
-
-    if ast[0] == 'do':
-        return Do(ast[1:], env, funs)
-    if ast[0] == 'fun':
-        return Fun(ast[1], ast[2:-1], ast[-1], env, funs)
-    if ast[0] == 'set':
-        return Set(ast[1], ast[2], env, funs)
-    if ast[0] == 'if':
-        return If(ast[1], ast[2], ast[3] if len(ast) == 4 else None, env, funs)
-    return Invocation(ast[0], ast[1:], env, funs)
-    raise ValueError("whoops! don't know how to eval %r", (ast, ))
+    make = nodes.get(type(ast))
+    if make is None:
+        ast = typed(ast)
+        make = nodes.get(type(ast))
+        if make is None:
+            raise ValueError(ast, env, funs)
+    return make(ast, env, funs)
 
 
 class Literal(BaseEval):
@@ -239,12 +732,12 @@ class Fun(BaseEval):
         return function
 
     def __repr__(self):
-        return "Fun(%s(%s) -> %r, env=%r, funs=%r)" % (
+        return "Fun(%s(%s) -> %s, env=%s, funs=%s)" % (
                 self.name,
                 ', '.join(self.params),
-                self.ast,
-                self.env,
-                self.funs)
+                brief(self.ast),
+                brief(self.env),
+                brief(self.funs))
 
 
 class Lookup(BaseEval):
@@ -271,7 +764,7 @@ class Lookup(BaseEval):
         return lookup(self.symbol, self.env, self.funs)
 
     def __repr__(self):
-        return "Lookup(%s, env=%r, funs=%r)" % (self.symbol, self.env, self.funs)
+        return "Lookup(%s, env=%s, funs=%s)" % (self.symbol, brief(self.env), brief(self.funs))
 
 
 class Set(BaseEval):
@@ -293,6 +786,9 @@ class Set(BaseEval):
         self.funs = funs
         self.env = env
         self.delegate = Eval(ast, env, funs)
+        self.start = None  # calls so far and reads of a global scope that tracks them
+        if getattr(env[-1], 'read_at', None) is not None:
+            self.start = funs.calls, env[-1].reads
 
     def __next__(self):
         if self.delegate is None:
@@ -306,13 +802,15 @@ class Set(BaseEval):
                 self.delegate = value
                 return Incomplete
             setbang(self.symbol, value, self.env)
+            if self.start is not None and self.env[-1].read_at is not None:
+                self.funs.wrote(self.symbol, *self.start, self.env[-1])
             return value
 
     def __repr__(self):
-        return "Set(%s, %r, env=%r)" % (
+        return "Set(%s, %s, env=%s)" % (
             self.symbol,
-            self.delegate if self.delegate else self.ast,
-            self.env)
+            brief(self.delegate if self.delegate else self.ast),
+            brief(self.env))
 
 
 class Do(BaseEval):
@@ -366,10 +864,10 @@ class Do(BaseEval):
             to_print = (tuple(self.values) +
                         (self.delegate,) +
                         self.forms[len(self.values)+1:])
-        return "Do(%s, env=%r, funs=%r)" % (
-            ', '.join(repr(x) for x in to_print),
-            self.env,
-            self.funs)
+        return "Do(%s, env=%s, funs=%s)" % (
+            ', '.join(brief(x) for x in to_print),
+            brief(self.env),
+            brief(self.funs))
 
 
 class If(BaseEval):
@@ -402,18 +900,18 @@ class If(BaseEval):
 
     def __repr__(self):
         if self.value is None:
-            return 'If(%r ? %r : %r, env=%r, funs=%r)' % (
-                self.cond if self.delegate is None else self.delegate,
-                self.case1,
-                self.case2,
-                self.env,
-                self.funs)
+            return 'If(%s ? %s : %s, env=%s, funs=%s)' % (
+                brief(self.cond if self.delegate is None else self.delegate),
+                brief(self.case1),
+                brief(self.case2),
+                brief(self.env),
+                brief(self.funs))
         else:
-            return 'If(%r, %r, env=%r, funs=%r)' % (
-                self.value,
-                self.case1 if self.value else self.case2,
-                self.env,
-                self.funs)
+            return 'If(%s, %s, env=%s, funs=%s)' % (
+                brief(self.value),
+                brief(self.case1 if self.value else self.case2),
+                brief(self.env),
+                brief(self.funs))
 
     def __next__(self):
         if self.value is not None:
@@ -435,6 +933,163 @@ class If(BaseEval):
         return Incomplete
 
 
+class While(BaseEval):
+    """(while cond body), or (loop body) with no cond, run in place
+
+    >>> run('(do (set i 0) (while (< i 3) (set i (+ i 1))) i)')
+    3
+    """
+    def __init__(self, cond, body, env, funs):
+        self.cond = cond
+        self.body = body
+        self.env = env
+        self.funs = funs
+        self.delegate = None
+        self.testing = False
+
+    def __repr__(self):
+        return 'While(%s, %s, env=%s, funs=%s)' % (
+            brief(self.cond),
+            brief(self.body if self.delegate is None or self.testing else self.delegate),
+            brief(self.env),
+            brief(self.funs))
+
+    def __next__(self):
+        if self.delegate is None:
+            self.testing = self.cond is not None
+            self.delegate = Eval(self.cond if self.testing else self.body, self.env, self.funs)
+            return Incomplete
+        value = next(self.delegate)
+        if value is Incomplete:
+            return value
+        if isinstance(value, BaseEval):
+            self.delegate = value
+            return Incomplete
+        if self.testing:
+            if not value:
+                return None
+            self.testing = False
+            self.delegate = Eval(self.body, self.env, self.funs)
+        else:
+            self.delegate = None
+        return Incomplete
+
+
+class For(BaseEval):
+    """(for var start end body), with var set to each of start..end-1
+
+    >>> run('(do (set total 0) (for i 0 5 (set total (+ total i))) total)')
+    10
+    """
+    def __init__(self, var, start, end, body, env, funs):
+        self.var = var
+        self.bounds = (start, end)
+        self.body = body
+        self.env = env
+        self.funs = funs
+        self.delegate = None
+        self.values = []  # start and end, then each value of var
+
+    def __repr__(self):
+        return 'For(%s in %s, %s, env=%s, funs=%s)' % (
+            self.var,
+            brief(self.values[-1] if len(self.values) > 2 else self.bounds),
+            brief(self.body if self.delegate is None else self.delegate),
+            brief(self.env),
+            brief(self.funs))
+
+    def __next__(self):
+        if self.delegate is None:
+            if len(self.values) < 2:
+                self.delegate = Eval(self.bounds[len(self.values)], self.env, self.funs)
+                return Incomplete
+            i = self.values[-1] + 1 if len(self.values) > 2 else self.values[0]
+            if i >= self.values[1]:
+                return None
+            if len(self.values) > 2:
+                self.values[-1] = i
+            else:
+                self.values.append(i)
+            setbang(self.var, i, self.env)
+            self.delegate = Eval(self.body, self.env, self.funs)
+            return Incomplete
+        value = next(self.delegate)
+        if value is Incomplete:
+            return value
+        if isinstance(value, BaseEval):
+            self.delegate = value
+            return Incomplete
+        self.delegate = None
+        if len(self.values) < 2:
+            self.values.append(value)
+        return Incomplete
+
+
+class Frame(BaseEval):
+    """Evaluation of the body of a user function
+
+    Remembers the arguments it was called with and the call number it
+    started at: any function called since then was called from inside
+    this frame, so it knows which functions its progress depends on.
+    Values set while the body runs live in its last scope, which is
+    rebuilt from the arguments on restart.
+
+    >>> funs = GlobalFunctions()
+    >>> funs['one'] = Function(name='one', params=(), ast=1, env=None, funs=funs)
+    >>> f = Frame('one', (), [{}], funs, funs.called('one')); f
+    Frame(one(), Eval(1, env=[{}], funs={'one': Function(name=one, params=(,), ast=1)}))
+    >>> f.depends_on(['one']), f.depends_on(['two'])
+    (True, False)
+    >>> next(f) is Incomplete, next(f)
+    (True, 1)
+    """
+    def __init__(self, name, args, env, funs, start):
+        self.name = name
+        self.args = args
+        self.env = env
+        self.funs = funs
+        self.start = start
+        self.step = funs.step
+        self.delegate = Eval(funs[name].ast, env, funs)
+        self.memo_keys = ()  # calls whose value this frame's value will be
+
+    def depends_on(self, names):
+        return any(self.funs.last_called.get(name, 0) >= self.start
+                   for name in names)
+
+    def restart(self):
+        """New frame running the current definition on the same arguments"""
+        func = self.funs.get(self.name)
+        if func is None or len(func.params) != len(self.args):
+            return None
+        env = self.env[:-1] + [Scope(dict(zip(func.params, self.args)), self.funs.meter)]
+        return Frame(self.name, self.args, env, self.funs,
+                     self.funs.called(self.name))
+
+    def __next__(self):
+        value = next(self.delegate)
+        if value is Incomplete:
+            return value
+        if isinstance(value, BaseEval) and not isinstance(value, Frame):
+            self.delegate = value
+            return Incomplete
+        # returning, or a tail call to a new frame that replaces this one
+        self.funs.depth -= 1
+        meter = getattr(self.env[-1], 'meter', None)
+        if meter is not None:
+            meter.bytes -= self.env[-1].bytes
+        if isinstance(value, Frame):
+            value.memo_keys += self.memo_keys
+        else:
+            for key in self.memo_keys:
+                self.funs.memo[key] = value
+        return value
+
+    def __repr__(self):
+        return "Frame(%s(%s), %s)" % (
+            self.name, ', '.join(brief(x) for x in self.args), brief(self.delegate))
+
+
 class Invocation(BaseEval):
     """
 
@@ -470,16 +1125,27 @@ class Invocation(BaseEval):
             func = self.values[0]
             args = self.values[1:]
             if isinstance(func, (Function, Lambda)):
-                if len(func.params) != len(args):
-                    raise TypeError('func %s takes %d param, %d args given: %r called on %r (-> %r)' %
-                                    (func.name, len(func.params), len(args), self.func_ast, self.arg_asts, args))
-                self.funs.about_to_call(func)
-                new_env = self.env[:-1] + [{p: a for p, a in zip(func.params, args)}]
-                #TODO save state here
-                return Eval(self.funs[self.values[0].name].ast, new_env, self.funs)
+                # calls by name to checked functions were checked by check_calls
+                if not (getattr(func, 'name', None) == self.func_ast and func.name in self.funs.checked) \
+                        and len(func.params) != len(args):
+                    raise TypeError('func %s takes %d param, %d args given: %s called on %s (-> %s)' %
+                                    (getattr(func, 'name', 'lambda'), len(func.params), len(args), brief(self.func_ast),
+                                     brief(self.arg_asts), brief(args)))
+                memo = self.funs.memo
+                key = memo.key(func.name, args) if memo is not None else None
+                if key is not None and key in memo:
+                    self.funs.remembered(func.name)
+                    return memo[key]
+                start = self.funs.about_to_call(func)
+                new_env = self.env[:-1] + [Scope(dict(zip(func.params, args)), self.funs.meter)]
+                self.funs.depth += 1
+                frame = Frame(func.name, tuple(args), new_env, self.funs, start)
+                if key is not None:
+                    frame.memo_keys = (key, )
+                return frame
             elif callable(func):
                 return func(*args)
-            raise ValueError("%r doesn't look like a function in %r" % (self.func_ast, self.arg_asts))
+            raise ValueError("%s doesn't look like a function in %s" % (brief(self.func_ast), brief(self.arg_asts)))
         else:
             value = next(self.delegate)
             if value is Incomplete:
@@ -495,21 +1161,37 @@ class Invocation(BaseEval):
 
     def __repr__(self):
         if self.delegate is None:
-            return "Invocation(%r(%s), env=%r, funs=%r)" % (
-                self.func_ast, ' '.join(repr(x) for x in self.arg_asts), self.env, self.funs)
+            return "Invocation(%s(%s), env=%s, funs=%s)" % (
+                brief(self.func_ast), ' '.join(brief(x) for x in self.arg_asts),
+                brief(self.env), brief(self.funs))
         if len(self.values) == 0:
-            return "Invocation(%r(%s), env=%r, funs=%r)" % (
-                self.delegate, ' '.join(repr(x) for x in self.arg_asts), self.env, self.funs)
+            return "Invocation(%s(%s), env=%s, funs=%s)" % (
+                brief(self.delegate), ' '.join(brief(x) for x in self.arg_asts),
+                brief(self.env), brief(self.funs))
         to_print = (tuple(self.values[1:]) +
                     (self.delegate,) +
                     self.asts[len(self.values)+2:])
-        return "Invocation(%s(%s), env=%r, funs=%r)" % (
-            self.values[0].name
-            if isinstance(self.values[0], (Function, Lambda))
-            else self.values[0].__name__,
-            ', '.join(repr(x) for x in to_print),
-            self.env,
-            self.funs)
+        return "Invocation(%s(%s), env=%s, funs=%s)" % (
+            getattr(self.values[0], 'name', None) or getattr(self.values[0], '__name__', 'lambda'),
+            ', '.join(brief(x) for x in to_print),
+            brief(self.env),
+            brief(self.funs))
+
+
+nodes = dispatch({
+    'number': lambda ast, env, funs: Literal(ast),
+    'text': lambda ast, env, funs: Literal(ast),
+    'symbol': Lookup,
+    'do': lambda ast, env, funs: Do(ast[1:], env, funs),
+    'fun': lambda ast, env, funs: Fun(ast[1], ast[2:-1], ast[-1], env, funs),
+    'lambda': lambda ast, env, funs: Invocation(ast[0], ast[1:], env, funs),  # no lambdas here
+    'set': lambda ast, env, funs: Set(ast[1], ast[2], env, funs),
+    'if': lambda ast, env, funs: If(ast[1], ast[2], ast[3] if len(ast) == 4 else None, env, funs),
+    'loop': lambda ast, env, funs: While(None, ast[1], env, funs),
+    'while': lambda ast, env, funs: While(ast[1], ast[2], env, funs),
+    'for': lambda ast, env, funs: For(ast[1], ast[2], ast[3], ast[4], env, funs),
+    'call': lambda ast, env, funs: Invocation(ast[0], ast[1:], env, funs),
+})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,91 @@
+"""
+Unix socket that takes code for a running Runner as a stream of forms
+
+Each top-level form is handed to the runner as soon as its closing paren
+arrives, without touching the script file or parsing the rest of it, and
+is answered with one line: the name of a function that was defined, the
+value of an expression, or an error.
+
+    $ echo '(fun ground y (if (> y 300) 300 y))' | nc -U repl.sock
+    ground
+
+>>> import os, tempfile
+>>> from obj_iter import Runner
+>>> path = os.path.join(tempfile.mkdtemp(), 'repl.sock')
+>>> server = Server(path); server.start(); server.ready.wait()
+True
+>>> runner = Runner('(do (fun inc x (+ x 1)) (inc 1))')
+>>> client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+>>> client.connect(path)
+>>> client.sendall(b'(+ 1 ')
+>>> client.sendall(b'2) (fun inc x (+ x 1)) (inc 2)')
+>>> for _ in range(3):
+...     while not server.pending: time.sleep(.001)
+...     server.answer(runner)
+...     client.recv(100)
+b'3\\n'
+b'inc\\n'
+b'3\\n'
+"""
+import codecs
+import os
+import queue
+import socket
+import threading
+import time
+from collections import deque
+
+from lisp_parser import Reader
+
+
+class Server(threading.Thread):
+    """Accepts connections on a background thread
+
+    Forms read from them wait in self.pending until the runner's thread
+    calls answer() between steps."""
+    def __init__(self, path):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.pending = deque()
+        self.ready = threading.Event()
+
+    def run(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(5)
+        self.ready.set()
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=self.handle, args=(conn, ), daemon=True).start()
+
+    def handle(self, conn):
+        """Queue each form from conn and send back its answer, in order"""
+        reader = Reader()
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        with conn:
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    return
+                try:
+                    forms = reader.feed(decoder.decode(data))
+                except (ValueError, StopIteration) as e:
+                    conn.sendall(("couldn't parse: %r\n" % (e, )).encode())
+                    continue
+                for form in forms:
+                    replies = queue.Queue(1)
+                    self.pending.append((form, replies.put))
+                    conn.sendall((replies.get() + '\n').encode())
+
+    def answer(self, runner):
+        """Push every waiting form to runner"""
+        while self.pending:
+            form, reply = self.pending.popleft()
+            try:
+                value = runner.push(form)
+            except Exception as e:
+                reply('error: %r' % (e, ))
+            else:
+                reply(str(value))
@@ -0,0 +1,102 @@
+"""
+Recording of builtins whose results aren't determined by the program,
+so execution after a rollback can be replayed quickly and exactly
+
+>>> from gamelib import PyFuncs
+>>> flips = iter([True, False, False])
+>>> builtins = PyFuncs({'coinflip': lambda: next(flips), 'display': print})
+>>> class Clock(object): i = 0
+>>> r = Recorder(builtins, Clock)
+>>> r['coinflip'](), r['display']('hi')
+hi
+(True, None)
+>>> Clock.i = 1
+>>> r['coinflip']()
+False
+>>> r.replay(0)
+>>> r['coinflip'](), r['display']('muted'), r['coinflip']()
+(True, None, False)
+>>> r.stop()
+>>> r['coinflip']()
+False
+"""
+from array import array
+from bisect import bisect_left
+
+from gamelib import PyFuncs
+
+
+IMPURE = ['mousex', 'mousey', 'mousepressedq', 'coinflip',
+          'upkeyq', 'downkeyq', 'leftkeyq', 'rightkeyq']
+OUTPUT = ['render', 'draw', 'draw_ball', 'background', 'display', 'sleep']
+
+
+class Recorder(PyFuncs):
+    """Layer of builtins that logs impure results by step number
+
+    Goes in an env between the builtins and the global scope. While
+    replaying, logged results are handed back in order instead and
+    output builtins do nothing, so a rollback can be fast-forwarded
+    without rendering or sleeping.
+
+    At most about keep results are logged for each builtin; a replay
+    from before the oldest of them gets fresh results instead.
+    """
+    def __init__(self, builtins, clock=None, impure=IMPURE, output=OUTPUT, keep=1 << 16):
+        PyFuncs.__init__(self)
+        self.builtins = builtins
+        self.keep = keep
+        self.clock = clock  # anything with an i attribute, usually a Runner
+        self.logs = {name: (array('q'), []) for name in impure}
+        self.replaying = None
+        for name in impure:
+            self[name] = self.recorded(name)
+        for name in output:
+            self[name] = self.muted(name)
+
+    def recorded(self, name):
+        steps, values = self.logs[name]
+
+        def call(*args):
+            queue = self.replaying and self.replaying[name]
+            if queue:
+                value = queue.pop()
+            else:
+                value = self.builtins[name](*args)
+            steps.append(self.clock.i)
+            values.append(value)
+            if len(values) > 2 * self.keep:
+                del steps[:-self.keep]
+                del values[:-self.keep]
+            return value
+        call.__name__ = name
+        return call
+
+    def muted(self, name):
+        def call(*args):
+            if self.replaying is None:
+                return self.builtins[name](*args)
+        call.__name__ = name
+        return call
+
+    def replay(self, step):
+        """Answer with results recorded from step on instead of calling
+
+        The log from step on is dropped; replayed results are logged
+        again at the steps they get used in this time around."""
+        self.replaying = {}
+        for name, (steps, values) in self.logs.items():
+            i = bisect_left(steps, step)
+            self.replaying[name] = values[i:][::-1]
+            del steps[i:]
+            del values[i:]
+
+    def stop(self):
+        self.replaying = None
+
+    def forget(self, step):
+        """Drop results from before step, which can no longer be replayed"""
+        for steps, values in self.logs.values():
+            i = bisect_left(steps, step)
+            del steps[:i]
+            del values[:i]
@@ -0,0 +1,97 @@
+"""
+Paces a Runner to a frame rate, with the frame ending at each (render)
+
+A frame is the steps up to and including a call to render. Once a frame
+is running past its share of the frame time, optional snapshots are
+skipped. Reloads and snapshot garbage collection happen between frames,
+and then the scheduler sleeps until the next frame is due. A frame that
+ends after the following one was due counts as dropped.
+
+>>> from gamelib import PyFuncs, builtins
+>>> from gen_iter import Scope
+>>> from obj_iter import Runner
+>>> env = [PyFuncs(dict(builtins, render=lambda: None)), Scope()]
+>>> r = Runner('(do (fun frame i (if (< i 5) (do (render) (frame (+ i 1))) i)) (frame 0))', env)
+>>> scheduler = Scheduler(r, fps=50)
+>>> scheduler.run()
+5
+>>> scheduler.frames, scheduler.dropped
+(6, 0)
+"""
+import time
+
+
+class Paced(object):
+    """Snapshot policy that defers to policy, except that it skips
+    snapshots while the current frame is late"""
+    def __init__(self, policy, scheduler):
+        self.policy = policy
+        self.scheduler = scheduler
+
+    def due(self, name, now):
+        return not self.scheduler.late() and self.policy.due(name, now)
+
+    def saved(self, name, now, cost):
+        self.policy.saved(name, now, cost)
+
+
+class Scheduler(object):
+    """Runs runner a frame at a time at fps frames a second
+
+    Steps may use budget of each frame's time before snapshots are put
+    off; what's left is slack for work between frames."""
+    def __init__(self, runner, fps=60, budget=.75, clock=time.perf_counter, sleep=time.sleep):
+        self.runner = runner
+        self.period = 1 / fps
+        self.budget = budget
+        self.clock = clock
+        self.sleep = sleep
+        self.frames = 0
+        self.dropped = 0
+        self.start = clock()
+        self.rendered = False
+
+        self.snapshots = runner.funs.snapshots
+        self.snapshots.policy = Paced(self.snapshots.policy, self)
+        self.snapshots.auto_collect = False
+
+        def rendering(render):
+            def rendered(*args):
+                self.rendered = True
+                return render(*args)
+            return rendered
+
+        runner.wrap('render', rendering)
+
+    def late(self):
+        return self.clock() > self.start + self.budget * self.period
+
+    def frame(self):
+        """Step until render is called or the program ends"""
+        self.start = self.clock()
+        self.rendered = False
+        value = None
+        while not self.rendered and not self.runner.done:
+            value = self.runner.step()
+        self.frames += 1
+        return value
+
+    def run(self, between=None):
+        """Run frames until the program ends, calling between after each
+        one, in the slack before the next is due"""
+        due = self.clock()
+        value = None
+        while not self.runner.done:
+            value = self.frame()
+            if between is not None:
+                between()
+            if self.snapshots.needs_collect():
+                self.snapshots.collect()
+            due += self.period
+            now = self.clock()
+            if now > due:
+                missed = int((now - due) / self.period) + 1
+                self.dropped += missed
+                due += missed * self.period
+            self.sleep(max(0, due - now))
+        return value
@@ -0,0 +1,417 @@
+"""
+Snapshots of eval trees that share storage by content
+
+Every node, environment frame and value in a snapshot is interned by
+its content, with children referred to by their ids, so subtrees and
+frames that several snapshots have in common are only stored once.
+
+>>> from obj_iter import Eval, GlobalFunctions
+>>> from lisp_parser import parse
+>>> funs = GlobalFunctions()
+>>> env = [{'a': 1}]
+>>> snapshots = Snapshots()
+>>> snapshots.save('f', Eval(parse('(+ a 1)'), env, funs), t=0, step=0)
+>>> size = len(snapshots.store.records)
+>>> snapshots.save('g', Eval(parse('(+ a 1)'), env, funs), t=1, step=1)
+>>> len(snapshots.store.records) == size
+True
+>>> tree = snapshots.restore(snapshots['g']); tree
+Eval(('+', 'a', 1), env=[{'a': 1}], funs={})
+>>> tree.env is env, tree.funs is funs
+(False, True)
+
+Containers that are one object in the tree stay one object, and equal
+but separate ones stay separate:
+
+>>> from obj_iter import Do
+>>> scope = {'x': 1}
+>>> shared, separate = [scope], [{'x': 1}]
+>>> snapshots.save('h', Do((1, 2), shared, funs), t=2, step=2)
+>>> snapshots.save('h', Do((shared, shared, separate), shared, funs), t=3, step=3)
+>>> a, b, c = snapshots.restore(snapshots['h']).forms
+>>> a is b, a is c, a == c
+(True, False, True)
+
+Scopes are frozen when captured, so an unchanged one is recorded in
+constant time and setting it afterwards doesn't touch the snapshot:
+
+>>> from gen_iter import Scope
+>>> scope = Scope({'x': 1})
+>>> snapshots.save('i', Eval('x', [scope], funs), t=4, step=4)
+>>> scope['x'] = 2
+>>> snapshots.restore(snapshots['i'])
+Eval('x', env=[{'x': 1}], funs={})
+"""
+import marshal
+import sys
+import time
+from array import array
+from collections import namedtuple
+
+from gen_iter import Scope
+from lisp_parser import Form, Symbol, Text
+
+
+ATOMS = (int, float, str, bool, type(None), Symbol, Text)
+ATOM_CODES = dict((t, bytes([i])) for i, t in enumerate(ATOMS))
+MARSHALLED = (int, float, str, bool, type(None))
+
+# record tags
+ATOM, TUPLE, FORM, LIST, DICT, SCOPE, ALIAS, NAMEDTUPLE, SHARED, NODE = [
+    tag.encode() for tag in 'atflds&nSN']
+
+Snapshot = namedtuple('Snapshot', ['root', 'aliases', 'uids', 't', 'step'])
+
+
+class Store(object):
+    """Content-addressed records, each a few bytes naming its children by id
+
+    A record is a tag byte and an array of ints: the ids of its
+    children, and for some tags an index into a table of classes or
+    attribute names first. The array's typecode byte comes after the
+    tag, and is the narrowest that holds its largest int. Atoms are
+    marshalled. Records are only read back when a snapshot is
+    restored. That decodes the whole tree at once, building each
+    immutable record once however many places it appears: merging
+    globals forward walks all of it straight away, and collect may drop
+    records that a lazily built node would still need.
+
+    >>> store = Store()
+    >>> root, aliases, uids = store.capture(((1, 'a'), [(1, 'a')]))
+    >>> key = store.records[root]; key[:1], fields(key), len(key)
+    (b't', [2, 4], 6)
+    >>> tree = store.decode(root, aliases, uids); tree
+    ((1, 'a'), [(1, 'a')])
+    >>> tree[0] is tree[1][0]
+    True
+
+    Scopes with the same contents share a record, and keep their own
+    uids on the side:
+
+    >>> one, two = Scope({'x': 1}), Scope({'x': 1})
+    >>> (root, a, uids), (_, b, _) = store.capture([one]), store.capture([two])
+    >>> a == b, store.decode(root, a, uids)[0].uid == one.uid
+    (True, True)
+    """
+    def __init__(self):
+        self.ids = {}
+        self.records = {}
+        self.constants = {}  # id(tuple) -> (tuple, record id) for immutable tuples
+        self.shared = {}  # id(obj) -> obj, for things snapshots don't copy
+        self.versions = {}  # id(vars) -> (vars, record id) for frozen Scope versions
+        self.atoms = {}  # (type, value) -> record id, to skip marshalling
+        self.classes = []  # node, namedtuple and Form classes, by index
+        self.class_ids = {}
+        self.names = []  # node attribute names, by index
+        self.name_ids = {}
+        self.next_id = 0
+        self.bytes = 0
+
+    def intern(self, key):
+        i = self.ids.get(key)
+        if i is None:
+            i = self.ids[key] = self.next_id
+            self.next_id += 1
+            self.records[i] = key
+            self.bytes += sys.getsizeof(key)
+        return i
+
+    def record(self, tag, fields):
+        top = max(fields) if fields else 0
+        code = 'H' if top < 1 << 16 else 'I' if top < 1 << 32 else 'q'
+        return self.intern(tag + code.encode() + array(code, fields).tobytes())
+
+    def class_id(self, cls):
+        i = self.class_ids.get(cls)
+        if i is None:
+            i = self.class_ids[cls] = len(self.classes)
+            self.classes.append(cls)
+        return i
+
+    def name_id(self, name):
+        i = self.name_ids.get(name)
+        if i is None:
+            i = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def capture(self, tree):
+        """Intern tree, returning its root id, the ids of the contents of
+        the mutable containers in it, indexed by their alias number, and
+        the uids of the Scopes among them (None for other containers)
+
+        uids are kept out of the records so equal Scopes share one."""
+        aliases = []
+        seen = {}
+        root = self.encode(tree, aliases, seen)
+        uids = tuple(alias[1] if type(alias) is tuple else None for alias in aliases)
+        return root, tuple(alias[0] if type(alias) is tuple else alias for alias in aliases), uids
+
+    def encode(self, x, aliases, seen):
+        t = type(x)
+        if t in ATOMS:
+            i = self.atoms.get((t, x))
+            if i is None:
+                i = self.atoms[t, x] = self.intern(
+                    ATOM + ATOM_CODES[t] + marshal.dumps(x if t in MARSHALLED else str(x)))
+            return i
+        if t is tuple or isinstance(x, Form):
+            cached = self.constants.get(id(x))
+            if cached is not None:
+                return cached[1]
+            refs = [self.encode(item, aliases, seen) for item in x]
+            i = self.record(TUPLE, refs) if t is tuple else self.record(FORM, [self.class_id(t)] + refs)
+            if all(type(item) in ATOMS or id(item) in self.constants for item in x):
+                self.constants[id(x)] = (x, i)
+            return i
+        if t is Scope or isinstance(x, (list, dict)) and not hasattr(x, '__deepcopy__'):
+            n = seen.get(id(x))
+            if n is None:
+                n = seen[id(x)] = len(aliases)
+                aliases.append(None)
+                if t is Scope:
+                    aliases[n] = (self.version(x, aliases, seen), x.uid)
+                elif isinstance(x, list):
+                    aliases[n] = self.record(LIST, [self.encode(item, aliases, seen) for item in x])
+                else:
+                    aliases[n] = self.record(DICT, [self.encode(item, aliases, seen)
+                                                    for kv in x.items() for item in kv])
+            return self.record(ALIAS, [n])
+        if isinstance(x, tuple) and hasattr(x, '_fields'):
+            return self.record(NAMEDTUPLE, [self.class_id(t)] +
+                               [self.encode(item, aliases, seen) for item in x])
+        if not hasattr(x, '__next__'):  # builtins, funs and so on aren't copied
+            self.shared[id(x)] = x
+            return self.record(SHARED, [id(x)])
+        fields = [self.class_id(t)]
+        name_ids = self.name_ids
+        for k, v in x.__dict__.items():
+            fields.append(name_ids[k] if k in name_ids else self.name_id(k))
+            fields.append(self.encode(v, aliases, seen))
+        return self.record(NODE, fields)
+
+    def version(self, scope, aliases, seen):
+        """Record id for the current version of a Scope, which is frozen
+        so that capturing it again before it is next set is O(1)"""
+        vars = scope.freeze()
+        cached = self.versions.get(id(vars))
+        if cached is not None:
+            return cached[1]
+        values = list(vars.values())
+        i = self.record(SCOPE, [self.encode(item, aliases, seen) for kv in vars.items() for item in kv])
+        if all(type(v) in ATOMS or id(v) in self.constants for v in values):
+            self.versions[id(vars)] = (vars, i)
+        return i
+
+    def decode(self, root, aliases, uids=None, scopes=None):
+        """Rebuild a captured tree; scopes, if given, is filled in with
+        its Scopes by uid"""
+        containers = []
+        for n, i in enumerate(aliases):
+            key = self.records[i]
+            tag = key[:1]
+            if tag == SCOPE:
+                scope = Scope()
+                if uids is not None:
+                    scope.uid = uids[n]
+                if scopes is not None:
+                    scopes[scope.uid] = scope
+                containers.append(scope)
+            else:
+                containers.append([] if tag == LIST else {})
+        built = {}
+        for container, i in zip(containers, aliases):
+            key = self.records[i]
+            refs = fields(key)
+            items = [self.build(ref, containers, built) for ref in refs]
+            if isinstance(container, list):
+                container.extend(items)
+            else:
+                container.update(zip(items[::2], items[1::2]))
+        return self.build(root, containers, built)
+
+    def build(self, i, containers, built):
+        """The value of record i; immutable ones are kept in built, so
+        each is only made once per decode"""
+        value = built.get(i, built)
+        if value is not built:
+            return value
+        key = self.records[i]
+        tag = key[:1]
+        if tag == ATOM:
+            t = ATOMS[key[1]]
+            value = marshal.loads(key[2:])
+            built[i] = value = value if t in MARSHALLED else t(value)
+            return value
+        refs = fields(key)
+        if tag == ALIAS:
+            return containers[refs[0]]
+        if tag == SHARED:
+            return self.shared[refs[0]]
+        if tag in (TUPLE, FORM):
+            items = [self.build(ref, containers, built) for ref in (refs if tag == TUPLE else refs[1:])]
+            value = tuple(items) if tag == TUPLE else self.classes[refs[0]](items)
+            if all(ref in built for ref in refs[tag == FORM:]):
+                built[i] = value
+            return value
+        cls = self.classes[refs[0]]
+        if tag == NAMEDTUPLE:
+            return cls(*[self.build(ref, containers, built) for ref in refs[1:]])
+        node = cls.__new__(cls)
+        for k, ref in zip(refs[1::2], refs[2::2]):
+            setattr(node, self.names[k], self.build(ref, containers, built))
+        return node
+
+    def children(self, key):
+        tag = key[:1]
+        if tag in (ATOM, ALIAS, SHARED):
+            return ()
+        refs = fields(key)
+        if tag in (TUPLE, LIST, DICT, SCOPE):
+            return refs
+        if tag == NODE:
+            return refs[2::2]
+        return refs[1:]
+
+    def collect(self, roots):
+        """Forget every record not reachable from roots"""
+        live = set()
+        todo = list(roots)
+        while todo:
+            i = todo.pop()
+            if i not in live:
+                live.add(i)
+                todo.extend(self.children(self.records[i]))
+        self.records = {i: self.records[i] for i in live}
+        self.ids = {key: i for i, key in self.records.items()}
+        self.constants = {k: v for k, v in self.constants.items() if v[1] in live}
+        self.versions = {k: v for k, v in self.versions.items() if v[1] in live}
+        self.atoms = {k: i for k, i in self.atoms.items() if i in live}
+        used = set(fields(key)[0] for key in self.records.values() if key[:1] == SHARED)
+        self.shared = {k: v for k, v in self.shared.items() if k in used}
+        self.bytes = sum(sys.getsizeof(key) for key in self.records.values())
+
+
+def fields(key):
+    """The ints after a record's tag and typecode"""
+    return memoryview(key)[2:].cast(chr(key[1])).tolist()
+
+
+class Always(object):
+    """Snapshot policy: before every call"""
+    def due(self, name, now):
+        return True
+
+    def saved(self, name, now, cost):
+        pass
+
+
+class EveryN(Always):
+    """Before every nth call"""
+    def __init__(self, n):
+        self.n = n
+        self.calls = {}
+
+    def due(self, name, now):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        return self.calls[name] >= self.n
+
+    def saved(self, name, now, cost):
+        self.calls[name] = 0
+
+
+class Interval(Always):
+    """At most once every so many seconds"""
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.last = {}
+
+    def due(self, name, now):
+        return now >= self.last.get(name, 0) + self.seconds
+
+    def saved(self, name, now, cost):
+        self.last[name] = now
+
+
+class Adaptive(Interval):
+    """Often enough to keep snapshotting a function to about fraction of
+    the time, going by how long its last snapshot took
+
+    >>> policy = Adaptive(.1)
+    >>> policy.saved('f', now=10, cost=.5)
+    >>> policy.due('f', 14), policy.due('f', 15)
+    (False, True)
+    """
+    def __init__(self, fraction=.05):
+        Interval.__init__(self, 0)
+        self.fraction = fraction
+        self.costs = {}
+
+    def due(self, name, now):
+        return now >= self.last.get(name, 0) + self.costs.get(name, 0) / self.fraction
+
+    def saved(self, name, now, cost):
+        self.last[name] = now
+        self.costs[name] = cost
+
+
+class Snapshots(object):
+    """Most recent snapshot of the eval tree for each function name
+
+    How often a function's calls are snapshotted is up to its policy in
+    self.policies, or self.policy; the first call always is, so there is
+    always a snapshot to roll back to from before a function's last call.
+
+    >>> snapshots = Snapshots(policy=EveryN(3))
+    >>> for step in range(5): snapshots.about_to_call('f', (), t=step, step=step)
+    >>> snapshots['f'].step
+    3
+    """
+    def __init__(self, store=None, policy=None):
+        self.store = Store() if store is None else store
+        self.saved = {}
+        self.collected_at = 1024
+        self.policy = Always() if policy is None else policy
+        self.policies = {}
+        self.auto_collect = True  # else whoever turned it off calls collect
+
+    def about_to_call(self, name, tree, t, step):
+        """Snapshot tree if the policy for name says so"""
+        policy = self.policies.get(name, self.policy)
+        if name in self.saved and not policy.due(name, t):
+            return
+        start = time.perf_counter()
+        self.save(name, tree, t, step)
+        policy.saved(name, t, time.perf_counter() - start)
+
+    def save(self, name, tree, t, step):
+        root, aliases, uids = self.store.capture(tree)
+        self.saved[name] = Snapshot(root, aliases, uids, t, step)
+        if self.auto_collect and self.needs_collect():
+            self.collect()
+
+    def needs_collect(self):
+        return len(self.store.records) > 2 * self.collected_at
+
+    def restore(self, snapshot, scopes=None):
+        return self.store.decode(snapshot.root, snapshot.aliases, snapshot.uids, scopes)
+
+    def collect(self):
+        roots = []
+        for snapshot in self.saved.values():
+            roots.append(snapshot.root)
+            roots.extend(snapshot.aliases)
+        self.store.collect(roots)
+        self.collected_at = max(1024, len(self.store.records))
+
+    def __getitem__(self, name):
+        return self.saved[name]
+
+    def __contains__(self, name):
+        return name in self.saved
+
+    def pop(self, name, default=None):
+        return self.saved.pop(name, default)
+
+    def __len__(self):
+        return len(self.saved)
@@ -0,0 +1,142 @@
+"""
+Many worker processes running one program that is parsed only once
+
+The supervisor parses and checks the script, then publishes the ast and
+its function asts, marshalled, into a shared memory segment. Workers are
+forked after builtins are built, attach to the segment by name and load
+the program from it instead of reading and parsing the script. A reload
+is published once; each worker notices the new version between steps
+and applies it like a file change.
+
+>>> program = Program.create()
+>>> program.publish(parse('(do (fun f x x) (f 1))'))
+>>> same = Program.attach(program.name)
+>>> version, ast, function_asts = same.read()
+>>> version, ast, sorted(function_asts)
+(2, ('do', ('fun', 'f', 'x', 'x'), ('f', 1)), ['f'])
+>>> same.read(since=version)
+>>> program.close(); program.unlink(); same.close()
+
+>>> supervisor = Supervisor('(do (fun f x (+ x 1)) (f 1))', workers=2)
+>>> supervisor.start()
+>>> sorted(supervisor.results.get(timeout=10) for _ in range(2))
+[2, 2]
+>>> supervisor.stop()
+"""
+import marshal
+import multiprocessing
+import struct
+import time
+from multiprocessing import shared_memory
+
+from gamelib import builtins
+from gen_iter import Scope
+from lisp_parser import parse, load, parsed_funs, plain, typed
+from obj_iter import Runner, changes
+
+
+HEADER = struct.Struct('qq')  # version, length of the marshalled program
+
+
+class Program(object):
+    """A parsed program in a shared memory segment
+
+    The version is odd while a new program is being written, so readers
+    retry instead of loading half of one."""
+    def __init__(self, shm):
+        self.shm = shm
+        self.name = shm.name
+
+    @classmethod
+    def create(cls, size=1 << 20):
+        return cls(shared_memory.SharedMemory(create=True, size=size))
+
+    @classmethod
+    def attach(cls, name):
+        return cls(shared_memory.SharedMemory(name=name))
+
+    def publish(self, ast, function_asts=None):
+        if function_asts is None:
+            function_asts = parsed_funs(ast)
+        data = marshal.dumps(plain((ast, function_asts)))
+        buf = self.shm.buf
+        if HEADER.size + len(data) > len(buf):
+            raise ValueError('program is %d bytes, shared memory only holds %d' %
+                             (len(data), len(buf) - HEADER.size))
+        version, _ = HEADER.unpack_from(buf)
+        HEADER.pack_into(buf, 0, version + 1, 0)
+        buf[HEADER.size:HEADER.size + len(data)] = data
+        HEADER.pack_into(buf, 0, version + 2, len(data))
+
+    def read(self, since=0):
+        """(version, ast, function_asts) if newer than since, else None"""
+        buf = self.shm.buf
+        while True:
+            version, length = HEADER.unpack_from(buf)
+            if version <= since:
+                return None
+            if version % 2:
+                time.sleep(0)
+                continue
+            try:
+                ast, function_asts = marshal.loads(buf[HEADER.size:HEADER.size + length])
+            except (ValueError, EOFError, TypeError):
+                continue  # overwritten while being read
+            if HEADER.unpack_from(buf)[0] == version:
+                return version, typed(ast), dict((name, typed(x)) for name, x in function_asts.items())
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def work(name, results, check_every=64):
+    """Run the program published under name, picking up reloads"""
+    program = Program.attach(name)
+    version, ast, _ = program.read()
+    runner = Runner(ast, [builtins, Scope()])
+    for value in runner:
+        if runner.i % check_every == 0:
+            new = program.read(since=version)
+            if new is not None:
+                version, ast, _ = new
+                change_set = changes(ast, runner.ast, runner.function_asts)
+                if change_set is not None:
+                    runner.apply(change_set)
+    program.close()
+    results.put(value)
+
+
+class Supervisor(object):
+    """Parses once and forks workers that share the parsed program"""
+    def __init__(self, s, workers=2, size=1 << 20):
+        self.context = multiprocessing.get_context('fork')
+        self.results = self.context.Queue()
+        self.program = Program.create(size)
+        self.processes = [self.context.Process(target=work, args=(self.program.name, self.results),
+                                               daemon=True)
+                          for _ in range(workers)]
+        self.ast = None
+        self.reload(s)
+
+    def reload(self, s):
+        """Publish new source to every worker, if it changed"""
+        ast, function_asts = load(s)
+        if ast == self.ast:
+            return
+        self.program.publish(ast, function_asts)
+        self.ast = ast
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def stop(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        self.program.close()
+        self.program.unlink()
@@ -0,0 +1,100 @@
+"""
+Keyframes of a running program's whole eval tree, for time travel
+
+A keyframe is taken every so many steps into a snapshots.Store, so each
+one only adds the records that changed since the last. Older keyframes
+are thinned out a generation at a time, leaving history that is dense
+near the present and sparser further back. Finding the keyframe for a
+step or a wall time is a binary search; Runner.seek restores it and
+reruns forward to the exact step.
+
+>>> from obj_iter import Runner
+>>> src = '''(do (fun count x (if (< x 100) (count (+ x 1)) x))
+...              (count 0))'''
+>>> r = Runner(src, timeline=Timeline(every=10, keep=4))
+>>> for value in r: pass
+>>> r.i, len(r.timeline)
+(2625, 26)
+>>> r.timeline.steps[:6].tolist()
+[320, 640, 960, 1280, 1440, 1600]
+>>> r.seek(1000)
+>>> r.i, [frame.args for _, _, frame in r.live_frames()][-1]
+(1000, (38,))
+>>> for value in r: pass
+>>> value
+100
+"""
+from array import array
+from bisect import bisect_right
+
+from snapshots import Snapshot, Store
+
+
+class Timeline(object):
+    """Keyframes every so many steps; the latest keep are that far apart,
+    the keep before those twice as far, and so on"""
+    def __init__(self, every=256, keep=64):
+        self.every = every
+        self.keep = keep
+        self.store = Store()
+        self.steps = array('q')
+        self.times = array('d')
+        self.keyframes = []
+        self.thinned_at = 0
+        self.collected_at = 1024
+
+    def due(self, step):
+        return step % self.every == 0
+
+    def record(self, tree, t, step):
+        root, aliases, uids = self.store.capture(tree)
+        self.steps.append(step)
+        self.times.append(t)
+        self.keyframes.append(Snapshot(root, aliases, uids, t, step))
+        if len(self.keyframes) >= self.thinned_at + self.keep:
+            self.thin()
+        if len(self.store.records) > 2 * self.collected_at:
+            self.collect()
+
+    def thin(self):
+        """Space keyframes twice as far apart every keep keyframes back"""
+        kept = []
+        for keyframe in reversed(self.keyframes):
+            if keyframe.step % (self.every << len(kept) // self.keep) == 0:
+                kept.append(keyframe)
+        self.replace(kept[::-1])
+        self.thinned_at = len(self.keyframes)
+
+    def truncate(self, step):
+        """Forget keyframes after step, which have no future after a seek"""
+        self.replace(self.keyframes[:bisect_right(self.steps, step)])
+
+    def replace(self, keyframes):
+        self.keyframes = keyframes
+        self.thinned_at = min(self.thinned_at, len(keyframes))
+        self.steps = array('q', [k.step for k in keyframes])
+        self.times = array('d', [k.t for k in keyframes])
+
+    def collect(self):
+        roots = []
+        for keyframe in self.keyframes:
+            roots.append(keyframe.root)
+            roots.extend(keyframe.aliases)
+        self.store.collect(roots)
+        self.collected_at = max(1024, len(self.store.records))
+
+    def before(self, step):
+        """Latest keyframe at or before step, or None"""
+        i = bisect_right(self.steps, step)
+        return self.keyframes[i - 1] if i else None
+
+    def step_at(self, t):
+        """Step of the latest keyframe at or before wall time t, or None"""
+        i = bisect_right(self.times, t)
+        return self.steps[i - 1] if i else None
+
+    def restore(self, keyframe, scopes=None):
+        return self.store.decode(keyframe.root, keyframe.aliases, keyframe.uids, scopes)
+
+    def __len__(self):
+        return len(self.keyframes)